@@ -1,439 +1,2781 @@
-"""-------------------------------------------------------------------------------
-Name:       AGO_Pro_Update.py
-Purpose:    Overwrite services in ArcGIS Online or Enterprise utilizing ArcGIS Pro Maps
-Verion:     4.0 Rev version.  For ArcGIS Online, publishes Hosted Feature Services only.
-            For ArcGIS Enterprise, it depends on where the data resides and how that data is
-            registered with ArcGIS Server.  If you have a connection to an SDE Enterprise
-            Geodatabase registered, this will be a non-Hosted feature service.  If you do not
-            have the connection registered, it will be Hosted.
-            how your data is registered within ArcGIS Server--app
-Updated:    06/25/2019
-Comments:   Removed publish sd item out of try/except.  Experienced inconsistent behaviors in environments
-            utilizing Active Directory Federated Services (ADFS) integration with Portal.
-            Improved publishing process when services have same relative name.
-            Account for connectionreset errors.
-Author:     Alexander J Brown - Solution Engineer Esri (alexander_brown@esri.com)
--------------------------------------------------------------------------------"""
-# import all the necessary modules
-import arcgis
-from arcgis.gis import GIS
-import arcpy
-import logging
-import csv
-import re
-import os
-import sys
-import time
-import configparser
-import datetime
-from datetime import datetime
-from logging import handlers
-
-
-# Logging function to establish where script logging will occur.
-def logging_start(name):
-    try:
-        master_log = logging.getLogger()
-        # Change logging level here (CRITICAL, ERROR, WARNING, INFO or DEBUG)
-        master_log.setLevel(logging.INFO)
-
-        if name.endswith('.py'):
-            fname = name[:-3]
-        else:
-            fname = name
-            pass
-
-        # Logging variables
-        max_bytes = 250000
-        backup_count = 1  # Max number appended to log files when MAX_BYTES reached
-        log_file = os.path.abspath(os.path.dirname(sys.argv[0])) + os.sep + 'Logs' + os.sep + fname + '.txt'
-
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-        fh = logging.handlers.RotatingFileHandler(log_file, 'a', max_bytes, backup_count)
-        # Change logging level here for log file (CRITICAL, ERROR, WARNING, INFO or DEBUG)
-        fh.setLevel(logging.INFO)
-        fh.setFormatter(formatter)
-        master_log.addHandler(fh)
-
-        return master_log
-
-    except:
-        error = 'Error: %s %s' % (sys.exc_info()[0], sys.exc_info()[1])
-        raise error
-
-
-# Parse through config file for all license types, workspace, output oracle table.
-def get_config(location, name):
-    try:
-        config = configparser.ConfigParser()
-        format_name = name[:-3]
-        config.read(location + os.sep + format_name + '.cfg')
-        agol_url = config.get('URL', 'agol_org')
-        user_name = config.get('Credentials', 'user_name')
-        pass_word = config.get('Credentials', 'pass_word')
-        project_location = config.get('Project', 'location')
-        organization = config.get('Sharing', 'org')
-        everyone = config.get('Sharing', 'everyone')
-        groups = config.get('Sharing', 'groups')
-        ago_folder = config.get('Sharing', 'folder')
-        options = config.get('Capabilities', 'options')
-        open_data = config.get('OpenData_Category', 'category')
-        logger.info('Parsed all variables from config file.')
-        return agol_url, user_name, pass_word, project_location, organization, everyone, groups, ago_folder, options, open_data
-
-    except configparser.Error as error:
-        logger.critical('Check get config function: %s' % error)
-        logger.critical('Check your config file!')
-
-
-# Main script to call functions & execute publishing process
-if __name__ == "__main__":
-    # Auto Determine where the file location the script was placed, establish location, name, output csv
-    scriptLocation = os.path.abspath(os.path.dirname(sys.argv[0])) + os.sep + 'Config'
-    scriptName = os.path.basename(sys.argv[0])
-    csv_path = os.path.abspath(os.path.dirname(sys.argv[0])) + os.sep + 'Logs\AGO_Pro_Update_Times.csv'
-    file_exists = os.path.isfile(csv_path)
-
-    # Start Logging
-    logger = logging_start(scriptName)
-    logger.info('**** Script: %s, was started. ****' % scriptName)
-    print('**** Script: %s, was started. ****' % scriptName)
-    start_time = time.strftime('%X %x %Z')
-
-    # Parse through config file
-    portal, user, password, project, shrOrg, shrEveryone, shrGroups, agol_folder, service_capabilities, open_cat = \
-        get_config(scriptLocation, scriptName)
-
-    # Set up feature service capabilitiy dictionary
-    option_dict = dict()
-    option_dict['capabilities'] = service_capabilities
-
-    # Sign into default portal using ArcPY to ensure proper licensing for Pro
-    try:
-        arcpy.SignInToPortal(portal, user, password)
-    except(arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
-        logger.error('Could not sign into Portal: %s' % e)
-        sys.exit(1)
-
-    # Set the path to the project
-    prjPath = project
-
-    # Local paths to create temporary content
-    relPath = sys.path[0] + '/' + 'tempDir'
-
-    # Set your environment and read in maps from ArcGIS Pro
-    try:
-        arcpy.env.overwriteOutput = True
-        prj = arcpy.mp.ArcGISProject(prjPath)
-        mp = prj.listMaps()
-    except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
-        print(e)
-        logger.error('Could not Open Project and list maps. Check your project path. %s' % e)
-        print('Could not Open Project and list maps. Check your project path. %s' % e)
-        logger.critical('---- Script Exited Before Finishing ----')
-        sys.exit('---- Script Exited Before Finishing ----Could not connect to Pro Project')
-
-    # Login to an existing organization
-    try:
-        gis = GIS(portal, user, password)
-        logger.info('Successfully connected to %s' % gis)
-        print('Successfully connected to %s' % gis)
-    except RuntimeError as e:
-        logger.critical('Please check your url in %s.cfg' % (scriptName[:-3]))
-        logger.critical('Please check your credentials in %s.cfg' % (scriptName[:-3]))
-        logger.critical('---- Script Exited Before Finishing ----')
-        sys.exit('---- Script Exited Before Finishing ----Could not connect to ArcGIS Online')
-
-    try:
-        # Creates a folder the given folder name from config file. Does nothing if the folder already exists.
-        # If owner is not specified, owner is set as the logged in user.
-        gis.content.create_folder(folder=agol_folder, owner=user)
-        logger.info('Portal Folder: %s' % agol_folder)
-    except RuntimeError as e:
-        logger.error('Please check your folder name in %s.cfg' % (scriptName[:-3]))
-
-    # IF folder is not set in config, default to root directory
-    if agol_folder == '':
-        agol_folder = '/'
-    elif agol_folder == ' ':
-        agol_folder = '/'
-    elif agol_folder is None:
-        agol_folder = '/'
-
-
-    # Loop through each map within the Pro Project.  Make sure map name is identical to feature service rest URL set
-    # for the service
-    for pro_map in mp:
-        logger.info('Processing "%s"...' % str(pro_map.name))
-        print('Processing "%s"...' % str(pro_map.name))
-
-        # Set variables for sd draft and sd
-        draftName = str(pro_map.name) + '.sddraft'
-        sdName = str(pro_map.name) + '.sd'
-        sddraft = os.path.join(relPath, draftName)
-        sd = os.path.join(relPath, sdName)
-        sd_fs_name = str(pro_map.name)
-
-        # If output csv that logs publishing times exists, open it.  If not, create & write header.
-        if file_exists is True:
-            output_file = open(csv_path, 'a')
-        else:
-            output_file = open(csv_path, 'a')
-            output_file.write('LogTime, Org, Service, Type, Duration(Min:Sec:Millsec)\n')
-            print('Writing header...')
-
-        # Create SD Draft
-        try:
-            sharing_draft = pro_map.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", sd_fs_name)
-            # Legacy
-            # The arcpy.sharing module was introduced at ArcGIS Pro 2.2 to provide a better experience when
-            # sharing web layers over the previously existing function CreateWebLayerSDDraft.
-            # arcpy.mp.CreateWebLayerSDDraft(pro_map, sddraft, sd_fs_name,'MY_HOSTED_SERVICES','FEATURE_ACCESS',
-            # True, True)
-        except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
-            logger.error(e)
-
-        # Export SD Draft
-        try:
-            sharing_draft.exportToSDDraft(sddraft)
-            # Legacy
-            # The arcpy.sharing module was introduced at ArcGIS Pro 2.2 to provide a better experience when
-            # sharing web layers over the previously existing function CreateWebLayerSDDraft.
-            # arcpy.mp.CreateWebLayerSDDraft(pro_map, sddraft, sd_fs_name,'MY_HOSTED_SERVICES','FEATURE_ACCESS',
-            # True, True)
-        except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
-            logger.error('Could not create SDDraft. Check permissions to script folder: %s' % e)
-            logger.error(e)
-
-
-        # Stage service in temporary location
-        try:
-            arcpy.StageService_server(sddraft, sd)
-        except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
-            logger.error('Could not stage service. Check staging location: %s' % e)
-
-        logger.info('SD File Created.')
-        print('SD File Created.')
-        logger_key = 0
-
-        # Find the SD, update it, publish /w overwrite and set sharing and metadata
-        try:
-            sdItem = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Service Definition")
-            print('List Returned for Service Definition search: %s' % sdItem)
-            for i, value in enumerate(sdItem):
-                match = re.search(r'\"(.*)\"', str(value)).group(1)
-                print(match)
-                print(sd_fs_name)
-                if match == sd_fs_name:
-                    n = i
-            try:
-                print("*************  1  ***************")
-                sdItem = sdItem[n]
-                sc = datetime.now()  # Current Datetime
-                update_dict = {'capabilities':'Query,Extract'}
-                try:
-                    sdItem.update(data=sd)
-                    logger.info('Uploading new Service Definition...')
-                    print('Uploading new Service Definition...')
-                    last = datetime.now() - sc  # Difference in time
-                except ConnectionResetError as e:
-                    logger.error(e)
-                    sdItem.update(data=sd)
-
-                # Write publishing time to output csv
-                org = str(gis).split("@")[1].split("//")[1].split(".")[0]
-                output = str(time.strftime('%X %x')) + ',' + org + ',' + str(pro_map.name) + ',Overwriting SD File,' + \
-                         str(last) + '\n'
-                output_file.write(output)
-            except (NameError, TypeError) as e:
-                print("*************  2  ***************")
-                logger.info('Item is not published...')
-                print('Item is not published...')
-                logger_key = 1
-
-                # Add item as service definition
-                sc = datetime.now()  # Current Datetime
-                try:
-                    sdItem = gis.content.add({'title': sd_fs_name}, data=sd, folder=agol_folder)
-                    logger.info('Uploading new Service Definition...')
-                    print('Uploading new Service Definition...')
-                except ValueError as e:
-                    logger.critical('Could not add service %s to Org' % sd_fs_name)
-                    logger.critical('Make sure you are signed into ArcGIS Pro. Save password if closing.')
-                last = datetime.now() - sc  # Difference in time
-                # Write publishing time to output csv
-                org = str(gis).split("@")[1].split("//")[1].split(".")[0]
-                output1 = str(time.strftime('%X %x')) + ',' + org + ',' + str(pro_map.name) + ',Add New SD,' + str(
-                    last) + \
-                          '\n'
-                output_file.write(output1)
-
-        except IndexError as e:
-            print("*************  3  ***************")
-            logger.info('Item is not published...')
-            print('Item is not published...')
-            logger_key = 1
-
-            # Add item as service definition
-            sc = datetime.now()  # Current Datetime
-            try:
-                print("*************  4  ***************")
-                sdItem = gis.content.add({'title': sd_fs_name}, data=sd, folder=agol_folder)
-                logger.info('Uploading new Service Definition...')
-                print('Uploading new Service Definition...')
-            except ValueError as e:
-                logger.critical('Could not add service %s to Org' % sd_fs_name)
-                logger.critical('Make sure you are signed into ArcGIS Pro. Save password if closing.')
-            last = datetime.now() - sc  # Difference in time
-            # Write publishing time to output csv
-            org = str(gis).split("@")[1].split("//")[1].split(".")[0]
-            output1 = str(time.strftime('%X %x')) + ',' + org + ',' + str(pro_map.name) + ',Add New SD,' + str(last) + \
-                '\n'
-            output_file.write(output1)
-
-        if logger_key == 0:
-            logger.info('Overwriting service: %s...' % pro_map.name)
-            print('Overwriting service: %s...' % pro_map.name)
-        else:
-            logger.info('Publishing service: %s...' % pro_map.name)
-            print('Publishing service: %s...' % pro_map.name)
-
-        # Publish/Overwrite feature service and share according to sharing above.
-        sc = datetime.now()  # Current Datetime
-        publish_key = 0
-
-        try:
-            print("*************  5  ***************")
-            fs = sdItem.publish(overwrite=True)
-        except Exception as e:
-            # Even if a timeout occurs, search and try and locate service. If found, the service published correctly.
-            try:
-                print("*************  6  ***************")
-                fs = sdItem.publish(overwrite=True)
-            except ConnectionResetError as e:
-                # Even if a timeout occurs, search and try and locate service. If found, the service published correctly.
-                fsItem = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Feature Service")
-                if len(fsItem) >= 1:
-                    publish_key = 0
-                else:
-                    logger.error('Could not publish service %s: %s' % (sd_fs_name, e))
-                    publish_key = 1
-                    print('**' + str(e) + '**')
-            except Exception as e:
-                # Even if a timeout occurs, search and try and locate service. If found, the service published correctly.
-                fsItem = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Feature Service")
-                if len(fsItem) >= 1:
-                    publish_key = 0
-                else:
-                    logger.error('Could not publish service %s: %s' % (sd_fs_name, e))
-                    publish_key = 1
-                    print('**' + str(e) + '**')
-            # fsItem = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Feature Service")
-            # if len(fsItem) >= 1:
-            #     publish_key = 0
-            # else:
-            #     logger.error('Could not publish service %s: %s' % (sd_fs_name, e))
-            #     publish_key = 1
-            #     print('**' + str(e) + '**')
-        except ConnectionResetError as e:
-            # Even if a timeout occurs, search and try and locate service. If found, the service published correctly.
-            fsItem = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Feature Service")
-            if len(fsItem) >= 1:
-                publish_key = 0
-            else:
-                logger.error('Could not publish service %s: %s' % (sd_fs_name, e))
-                publish_key = 1
-                print('**' + str(e) + '**')
-
-        last = datetime.now() - sc  # Difference in time
-
-        if publish_key == 0:
-            # Write publishing time to output csv
-            org = str(gis).split("@")[1].split("//")[1].split(".")[0]
-            output = str(time.strftime('%X %x')) + ',' + org + ',' + str(pro_map.name) + ',Publishing,' + str(last) + \
-                     '\n'
-            output_file.write(output)
-
-            try:
-                fs = gis.content.search("{} AND owner:{}".format(sd_fs_name, user), item_type="Feature Service")
-                for i, value in enumerate(fs):
-                    match = re.search(r'\"(.*)\"', str(value)).group(1)
-                    if match == sd_fs_name:
-                        n = i
-                fs = fs[n]
-
-                # Update Capabilities
-                flc = arcgis.features.FeatureLayerCollection(fs.url, gis)
-                flc.manager.update_definition(option_dict)
-                logger.info('Added capabilities to service: %s' % option_dict)
-                fs.share(org=shrOrg, everyone=shrEveryone, groups=shrGroups)
-                logger.info('Sharing: Org: %s, Everyone: %s, Groups: %s' % (shrOrg, shrEveryone, shrGroups))
-                print('Sharing: Org: %s, Everyone: %s, Groups: %s' % (shrOrg, shrEveryone, shrGroups))
-
-                # Define metadata
-                service_snippet = '{} in York County, PA.'.format(sd_fs_name)
-                service_description = '{} in York County. Intended for illustration and demonstration purposes only.'.format(sd_fs_name)
-                service_terms_of_use = 'FOR PUBLIC DISTRIBUTION. Layer should not be used at scales larger than 1:2400'
-                service_credits = 'York County Planning Commission (YCPC)'
-                service_tags = ['Open Data','{}'.format(open_cat)]
-
-                # Create update dict
-                item_properties = {'snippet' : service_snippet,
-                                   'description' : service_description,
-                                   'licenseInfo' : service_terms_of_use,
-                                   'accessInformation' : service_credits,
-                                   'tags' : service_tags}
-
-                # If Statement on fs items
-                # Update properties if AGOL item are empty ('' or null). If not, ignore update items.
-                # This will essentially provide information to AGOL item if no information is provided.
-                # This is my alternative because I should not get fs.properties working on my AGOL.
-                # fs.properties mentions that there is no values for some reason
-                #print(type(fs.properties))
-                if fs.description == None or fs.tags == None or fs.licenseInfo == None:
-                    print('AGOL Items are empty. Updating Item Properties for %s' % (sd_fs_name))
-                    logger.info('AGOL Items are empty. Updating Item Properties for %s' % (sd_fs_name))
-                    fs.update(item_properties)
-##                elif fs.description == '' or fs.tags == '' or fs.licenseInfo == '':
-##                    print('AGOL Items are empty. Updating Item Properties for %s' % (sd_fs_name))
-##                    logger.info('AGOL Items are empty. Updating Item Properties for %s' % (sd_fs_name))
-##                    fs.update(item_properties)
-                else:
-                    print("AGOL Item is not empty")
-                    logger.info('AGOL Item is not empty for %s' % (sd_fs_name))
-
-                logger.info('{}'.format(fs.tags))
-                print('{}'.format(fs.tags))
-
-##                #Added fs.properties logic that I could not get to work (works for Alex Brown but not here). But, wanted to include
-##                #If you can get to work probably a better solution then above if statement
-##                fs.url
-##                print(type(fs.properties))
-##
-##                new_dict = {}
-##                new_dict = fs.properties
-##
-##                new_dict
-##
-##                new_dict['copyrightText']
-##
-##                if new_dict['copyrightText'] == '':
-##                    print('empty')
-##                elif new_dict['copyrightText'] == null:
-##                    print('empty')
-
-            except Exception as e:
-                logger.error('Could not share service: %s' % e)
-
-            logger.info('-* Layer "%s" has been published. *-' % str(pro_map.name))
-            print('-* Layer "%s" has been published. *-' % str(pro_map.name))
-
-            n = None
-
-    # Close output csv for logging time to publish.
-    output_file.close()
-
-    logger.info('---- Script: %s completed. ----' % scriptName)
-    print('---- Script: %s completed. ----' % scriptName)
-
+"""-------------------------------------------------------------------------------
+Name:       AGO_Pro_Update.py
+Purpose:    Overwrite services in ArcGIS Online or Enterprise utilizing ArcGIS Pro Maps
+Verion:     4.0 Rev version.  For ArcGIS Online, publishes Hosted Feature Services only.
+            For ArcGIS Enterprise, it depends on where the data resides and how that data is
+            registered with ArcGIS Server.  If you have a connection to an SDE Enterprise
+            Geodatabase registered, this will be a non-Hosted feature service.  If you do not
+            have the connection registered, it will be Hosted.
+            how your data is registered within ArcGIS Server--app
+Updated:    06/25/2019
+Comments:   Removed publish sd item out of try/except.  Experienced inconsistent behaviors in environments
+            utilizing Active Directory Federated Services (ADFS) integration with Portal.
+            Improved publishing process when services have same relative name.
+            Account for connectionreset errors.
+Author:     Alexander J Brown - Solution Engineer Esri (alexander_brown@esri.com)
+-------------------------------------------------------------------------------"""
+# import all the necessary modules.  arcpy and arcgis take seconds to import and are loaded on first use (see
+# LazyModule).
+import time
+_import_started = time.perf_counter()
+import argparse
+import asyncio
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import math
+import requests
+import csv
+import os
+import queue
+import re
+import shutil
+import socketserver
+import sys
+import threading
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import configparser
+import contextlib
+import copy
+import datetime
+from datetime import datetime, timedelta
+from logging import handlers
+
+# Root logger.  Replaced by logging_start when run as a script; staging processes log through it as-is.
+logger = logging.getLogger()
+
+# Startup phases of the current run (imports, config, sign in, ...) as timed spans, logged by log_startup
+_startup = [{'map': '', 'phase': 'imports', 'seconds': time.perf_counter() - _import_started}]
+
+# ArcGIS Pro project handles opened by this process, keyed by project path, with the project file's modified time
+_projects = dict()
+
+# HTTP sessions for direct REST calls, one per portal and user so connections are pooled and reused
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+# Signed in GIS sessions and content indexes, keyed by portal and user, and rate limits keyed by organization
+_gis_sessions = dict()
+_indexes = dict()
+_rate_limits = dict()
+
+# Portal and user ArcPy is signed into, by process id.  Every staging process has to sign in for itself.
+_arcpy_portals = dict()
+
+# Lock around arcpy cursors opened from upload threads.  arcpy is not thread safe.
+_arcpy_lock = threading.Lock()
+
+# Errors worth retrying: dropped connections and timeouts.  Errors reported by the portal are not retried.
+RETRYABLE = (ConnectionError, TimeoutError, requests.exceptions.RequestException)
+
+# Type keyword prefix that records on a Service Definition item the cache key of the SD file it holds
+SD_HASH_KEYWORD = 'sdhash:'
+
+# Backing services of a map published blue/green are titled <map>_Blue and <map>_Green.  The live view records the
+# one it shows in its type keywords; the view it last replaced is kept as <map>_Previous.
+BLUEGREEN_COLORS = ('Blue', 'Green')
+BLUEGREEN_KEYWORD = 'bluegreen:'
+
+# Fields managed by the geodatabase or the hosted service that are never compared or sent as edits
+SYSTEM_FIELDS = ('OID', 'Geometry', 'GlobalID', 'Raster', 'Blob')
+SYSTEM_FIELD_NAMES = ('shape_length', 'shape_area', 'shape__length', 'shape__area', 'st_length(shape)',
+                      'st_area(shape)')
+
+
+# Every item owned by the publishing user, keyed by exact title and item type.  Built once per run from a paged
+# listing of the user's root folder and subfolders, then patched as items are added or published, so looking up a
+# map's Service Definition or Feature Service never needs a search round trip.  Every listing and search waits on
+# the organization's rate limiter.
+class ContentIndex(object):
+    def __init__(self, gis, user, limiter=None):
+        self._gis = gis
+        self._user = user
+        self._limiter = limiter
+        self._items = dict()
+        self._expected = set()
+        self._lock = threading.Lock()
+        self.refresh()
+
+    # Re-list all of the user's content.  User.items pages through each folder.
+    def refresh(self):
+        owner = throttled(self._limiter, self._gis.users.get, self._user)
+        items = dict()
+        self.folders = dict((f['title'], f['id']) for f in owner.folders)
+        for folder in [None] + list(self.folders):
+            for item in throttled(self._limiter, owner.items, folder=folder, max_items=10000):
+                key = (item.title, item.type)
+                if key in items:
+                    logger.warning('More than one %s titled "%s", using %s' % (item.type, item.title,
+                                                                               items[key].id))
+                    continue
+                items[key] = item
+        with self._lock:
+            self._items = items
+            self._expected = set()
+        logger.info('Indexed %s items owned by %s' % (len(items), self._user))
+
+    # Item with this exact title and type, or None.  An expected item (see expect) that is not indexed yet is looked
+    # up with one exact-title search and patched into the index.
+    def get(self, title, item_type):
+        with self._lock:
+            item = self._items.get((title, item_type))
+            expected = (title, item_type) in self._expected
+            self._expected.discard((title, item_type))
+        if item is not None or not expected:
+            return item
+        query = 'title:"{}" AND owner:{}'.format(title, self._user)
+        for item in throttled(self._limiter, self._gis.content.search, query, item_type=item_type):
+            if item.title == title and item.type == item_type:
+                self.put(item)
+                return item
+        return None
+
+    # Note an item made by a call that does not return it (the view replace_service keeps), so the next get looks
+    # it up rather than miss.
+    def expect(self, title, item_type):
+        with self._lock:
+            self._items.pop((title, item_type), None)
+            self._expected.add((title, item_type))
+
+    # Record an item added or published during this run.
+    def put(self, item):
+        with self._lock:
+            self._items[(item.title, item.type)] = item
+
+    # Forget an item, e.g. after it is deleted.
+    def discard(self, title, item_type):
+        with self._lock:
+            self._items.pop((title, item_type), None)
+
+
+# A module imported the first time one of its attributes is used, so runs that never need it (--plan, a config
+# error) do not wait for it.  load() imports it now, timing the import as a startup phase.
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            with timed(_startup.append, '', 'import ' + self._name):
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+arcpy = LazyModule('arcpy')
+arcgis = LazyModule('arcgis')
+
+
+# Exponential backoff schedule: base seconds, times factor after each attempt, capped at maximum.  call() retries a
+# function on dropped connections and timeouts up to attempts times in all, each attempt waiting on limiter.
+class RetryPolicy(object):
+    def __init__(self, attempts, base, factor, maximum, limiter=None):
+        self.attempts = attempts
+        self.base = base
+        self.factor = factor
+        self.maximum = maximum
+        self.limiter = limiter
+
+    def delay(self, attempt):
+        return min(self.base * self.factor ** attempt, self.maximum)
+
+    def call(self, fn, what, span=None):
+        for attempt in range(self.attempts):
+            try:
+                return throttled(self.limiter, fn)
+            except RETRYABLE as e:
+                if attempt + 1 >= self.attempts:
+                    raise
+                logger.warning('%s failed (attempt %s of %s), retrying: %s' % (what, attempt + 1, self.attempts, e))
+                if span is not None:
+                    span['retries'] += 1
+                time.sleep(self.delay(attempt))
+
+
+# Token bucket limiting the calls made to one organization to rate per second on average, in bursts of up to burst.
+# A rate of 0 means no limit.  Callers over the limit reserve the next free slot and sleep until it comes.
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            delay = max(0, (1 - self._tokens) / self.rate)
+            self._tokens -= 1
+        if delay:
+            time.sleep(delay)
+
+
+# Call fn once limiter (a RateLimiter, or None) lets another call through
+def throttled(limiter, fn, *args, **kwargs):
+    if limiter is not None:
+        limiter.wait()
+    return fn(*args, **kwargs)
+
+
+# Logging function to establish where script logging will occur.
+def logging_start(name, log_dir=None):
+    try:
+        master_log = logging.getLogger()
+        # Change logging level here (CRITICAL, ERROR, WARNING, INFO or DEBUG)
+        master_log.setLevel(logging.INFO)
+
+        if name.endswith('.py'):
+            fname = name[:-3]
+        else:
+            fname = name
+            pass
+
+        # Logging variables
+        max_bytes = 250000
+        backup_count = 1  # Max number appended to log files when MAX_BYTES reached
+        if log_dir is None:
+            log_dir = os.path.abspath(os.path.dirname(sys.argv[0])) + os.sep + 'Logs'
+        log_file = log_dir + os.sep + fname + '.txt'
+
+        # Already logging there (the script was run again from the same process)
+        for handler in master_log.handlers:
+            if getattr(handler, 'baseFilename', None) == os.path.abspath(log_file):
+                return master_log
+
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+        fh = logging.handlers.RotatingFileHandler(log_file, 'a', max_bytes, backup_count)
+        # Change logging level here for log file (CRITICAL, ERROR, WARNING, INFO or DEBUG)
+        fh.setLevel(logging.INFO)
+        fh.setFormatter(formatter)
+        master_log.addHandler(fh)
+
+        return master_log
+
+    except:
+        error = 'Error: %s %s' % (sys.exc_info()[0], sys.exc_info()[1])
+        raise error
+
+
+# Parse through config file for all license types, workspace, output oracle table.
+def get_config(location, name):
+    try:
+        config = configparser.ConfigParser()
+        format_name = name[:-3]
+        config.read(location + os.sep + format_name + '.cfg')
+        agol_url = config.get('URL', 'agol_org')
+        user_name = config.get('Credentials', 'user_name')
+        pass_word = config.get('Credentials', 'pass_word')
+        project_location = config.get('Project', 'location')
+        organization = config.get('Sharing', 'org')
+        everyone = config.get('Sharing', 'everyone')
+        groups = config.get('Sharing', 'groups')
+        ago_folder = config.get('Sharing', 'folder')
+        options = config.get('Capabilities', 'options')
+        open_data = config.get('OpenData_Category', 'category')
+        logger.info('Parsed all variables from config file.')
+        return agol_url, user_name, pass_word, project_location, organization, everyone, groups, ago_folder, options, open_data
+
+    except configparser.Error as error:
+        logger.critical('Check get config function: %s' % error)
+        logger.critical('Check your config file!')
+        logger.critical('---- Script Exited Before Finishing ----')
+        sys.exit('---- Script Exited Before Finishing ----Check %s: %s' % (location + os.sep + format_name + '.cfg',
+                                                                          error))
+
+
+# Read and check a config file: the settings get_config returns, and the options of get_options.  Exits the script
+# when the config cannot be used.
+def read_config(location, name):
+    values = get_config(location, name)
+    try:
+        options = get_options(location, name)
+    except (configparser.Error, ValueError) as error:
+        logger.critical('Check your config file! %s' % error)
+        logger.critical('---- Script Exited Before Finishing ----')
+        sys.exit('---- Script Exited Before Finishing ----Check %s: %s' % (location + os.sep + name[:-3] + '.cfg',
+                                                                          error))
+    return values, options
+
+
+# Parse the optional tuning sections of the config file.  Every value has a default so older config files still run.
+def get_options(location, name):
+    config = configparser.ConfigParser()
+    format_name = name[:-3]
+    config.read(location + os.sep + format_name + '.cfg')
+    options = dict()
+    options['pipelined'] = config.getboolean('Performance', 'pipelined', fallback=False)
+    options['stage_workers'] = config.getint('Performance', 'stage_workers', fallback=2)
+    options['upload_workers'] = config.getint('Performance', 'upload_workers', fallback=4)
+    options['skip_unchanged'] = config.getboolean('Performance', 'skip_unchanged', fallback=False)
+    options['requests_per_second'] = config.getfloat('Performance', 'requests_per_second', fallback=0)
+    options['force'] = False
+
+    # SD files at least multipart_mb in size are uploaded in parts of part_mb, parallel_parts at a time
+    options['upload'] = dict()
+    options['upload']['multipart_mb'] = config.getfloat('Upload', 'multipart_mb', fallback=100)
+    options['upload']['part_mb'] = config.getfloat('Upload', 'part_mb', fallback=20)
+    options['upload']['parallel_parts'] = config.getint('Upload', 'parallel_parts', fallback=4)
+
+    # Backoff for retried uploads and sharing calls, and for polling publish jobs
+    options['retry'] = RetryPolicy(config.getint('Retry', 'attempts', fallback=5),
+                                   config.getfloat('Retry', 'base_seconds', fallback=2),
+                                   config.getfloat('Retry', 'factor', fallback=2),
+                                   config.getfloat('Retry', 'max_seconds', fallback=60))
+    options['poll'] = RetryPolicy(0,
+                                  config.getfloat('Retry', 'poll_seconds', fallback=2),
+                                  config.getfloat('Retry', 'factor', fallback=2),
+                                  config.getfloat('Retry', 'poll_max_seconds', fallback=30))
+    options['publish_timeout'] = config.getfloat('Retry', 'publish_timeout_minutes', fallback=60) * 60
+
+    # Staged SD files are kept in a content addressed cache under directory (tempDir/SDCache when blank), trimmed to
+    # max_mb and max_age_days after each run
+    options['cache'] = None
+    if config.getboolean('Cache', 'enabled', fallback=True):
+        options['cache'] = {'directory': config.get('Cache', 'directory', fallback='').strip(),
+                            'max_mb': config.getfloat('Cache', 'max_mb', fallback=2048),
+                            'max_age_days': config.getfloat('Cache', 'max_age_days', fallback=14)}
+
+    # Published services are checked against statistics of the data they were published from; extents may differ
+    # by extent_tolerance of their size and edit dates by date_tolerance_seconds
+    options['verify'] = None
+    if config.getboolean('Verify', 'enabled', fallback=True):
+        options['verify'] = {'extent_tolerance': config.getfloat('Verify', 'extent_tolerance', fallback=0.001),
+                             'date_tolerance_ms': config.getfloat('Verify', 'date_tolerance_seconds',
+                                                                  fallback=1) * 1000}
+
+    # Per-map settings live in sections named [Map:<map name>]
+    options['maps'] = dict()
+    for section in config.sections():
+        if not section.startswith('Map:'):
+            continue
+        map_options = dict()
+        map_options['mode'] = config.get(section, 'mode', fallback='overwrite').strip().lower()
+        map_options['key_field'] = config.get(section, 'key_field', fallback='').strip()
+        map_options['compare_field'] = config.get(section, 'compare_field', fallback='').strip()
+        map_options['batch_size'] = config.getint(section, 'batch_size', fallback=1000)
+        map_options['trim'] = config.getboolean(section, 'trim', fallback=False)
+        map_options['drop_fields'] = split_list(config.get(section, 'drop_fields', fallback=''))
+        map_options['drop_hidden_fields'] = config.getboolean(section, 'drop_hidden_fields', fallback=True)
+        map_options['scale_limit'] = config.getfloat(section, 'scale_limit', fallback=2400)
+        map_options['tolerance_mm'] = config.getfloat(section, 'tolerance_mm', fallback=0.2)
+        if map_options['mode'] not in ('overwrite', 'sync', 'bluegreen'):
+            logger.warning('[%s] unknown mode "%s", using overwrite' % (section, map_options['mode']))
+            map_options['mode'] = 'overwrite'
+        if map_options['mode'] == 'sync' and not (map_options['key_field'] and map_options['compare_field']):
+            logger.warning('[%s] sync mode needs key_field and compare_field, using overwrite' % section)
+            map_options['mode'] = 'overwrite'
+        # Sync compares and edits the untrimmed data, which would neither match a trimmed service's schema nor keep
+        # its geometry generalized
+        if map_options['mode'] == 'sync' and map_options['trim']:
+            logger.warning('[%s] trim does not work with sync mode, syncing untrimmed' % section)
+            map_options['trim'] = False
+        options['maps'][section[len('Map:'):].strip()] = map_options
+    # Watch mode: poll the project's data every poll_seconds, publish a changed map once it has been quiet for
+    # debounce_seconds (or latency_minutes after its first change at the latest), answer on control_port
+    options['watch'] = {'poll_seconds': config.getfloat('Watch', 'poll_seconds', fallback=30),
+                        'debounce_seconds': config.getfloat('Watch', 'debounce_seconds', fallback=60),
+                        'latency_seconds': config.getfloat('Watch', 'latency_minutes', fallback=5) * 60,
+                        'control_port': config.getint('Watch', 'control_port', fallback=8765),
+                        'index_refresh_seconds': config.getfloat('Watch', 'index_refresh_minutes', fallback=60) * 60}
+    logger.info('Parsed performance options: %s' % options)
+    return options
+
+
+# Settings for one map, falling back to a full overwrite for maps without a [Map:<name>] section.
+def map_options(options, map_name):
+    return options['maps'].get(map_name, {'mode': 'overwrite', 'key_field': '', 'compare_field': '',
+                                          'batch_size': 1000, 'trim': False})
+
+
+# Open an ArcGIS Pro project once per process and reuse the handle for every map staged by that process.  The project
+# is opened again once the .aprx has been saved since, so long running processes see the saved maps.
+def open_project(project_path):
+    try:
+        modified = os.path.getmtime(project_path)
+    except OSError:
+        modified = None
+    if project_path not in _projects or _projects[project_path][0] != modified:
+        arcpy.env.overwriteOutput = True
+        _projects[project_path] = (modified, arcpy.mp.ArcGISProject(project_path))
+    return _projects[project_path][1]
+
+
+# Sign ArcPy into a portal, unless this process is signed into it already.  Staging needs a signed in portal for the
+# Pro license and to stage for its hosting server.
+def arcpy_sign_in(portal, user, password):
+    if _arcpy_portals.get(os.getpid()) != (portal, user):
+        arcpy.SignInToPortal(portal, user, password)
+        _arcpy_portals[os.getpid()] = (portal, user)
+
+
+# Short name of the organization, e.g. yorkcounty for https://yorkcounty.maps.arcgis.com, used in the timing logs.
+def org_name(gis):
+    return str(gis).split("@")[1].split("//")[1].split(".")[0]
+
+
+# Time one phase of a map's pipeline.  Yields the span so the phase can add the bytes it uploaded, the retries it
+# needed or a different outcome; an exception marks the span as an error.  Finished spans go to sink, which is
+# Timings.record in the main process and a list handed back to it from the staging processes.  csv_type names the
+# row written to the publishing times csv for the phases it has always recorded.
+@contextlib.contextmanager
+def timed(sink, map_name, phase, csv_type=None):
+    span = {'map': map_name, 'phase': phase, 'start': time.time(), 'seconds': 0.0, 'bytes': 0, 'retries': 0,
+            'outcome': 'ok', 'csv': csv_type}
+    started = time.perf_counter()
+    try:
+        yield span
+    except Exception:
+        span['outcome'] = 'error'
+        raise
+    finally:
+        span['seconds'] = time.perf_counter() - started
+        sink(span)
+
+
+# Nearest-rank quantile of a sorted list.
+def quantile(values, q):
+    return values[max(0, int(math.ceil(q * len(values))) - 1)]
+
+
+# Durations in the publishing times csv, as str(timedelta) wrote them: "0:01:02.345000", "0:00:07",
+# "1 day, 2:03:04", with or without spaces around them
+DURATION = re.compile(r'^\s*(?:(\d+)\s+days?,\s*)?(?:(\d+):)?(\d+):(\d+(?:\.\d*)?)\s*$')
+
+# Rows of the publishing times csv counted towards a map's cost, by the step they time.  New and overwritten SDs
+# are both the upload.
+COST_TYPES = {'Add New SD': 'Overwriting SD File', 'Overwriting SD File': 'Overwriting SD File',
+              'Publishing': 'Publishing', 'Sync Edits': 'Sync Edits', 'Swapping View': 'Swapping View'}
+
+# Cost of a map with no history, when no map of the run has any either
+DEFAULT_COST = 60.0
+
+
+# Seconds in a duration from the publishing times csv, or None for anything else (the header, MB/s rows, damage).
+def parse_duration(text):
+    match = DURATION.match(text)
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+# Time a row of the publishing times csv was logged, or None when it cannot be read
+def logged_at(text):
+    try:
+        return datetime.strptime(text.strip(), '%X %x')
+    except ValueError:
+        return None
+
+
+# Read the publishing times csv one row at a time into the last `keep` durations of each step of each map, keyed by
+# (org, map).  Rows that are not durations are skipped.  With before, so are rows logged at or after it (and rows
+# whose time cannot be read), which freezes the history other machines are still appending to.
+def load_history(csv_path, keep=5, before=None):
+    history = dict()
+    try:
+        with open(csv_path, 'r', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 5 or row[3].strip() not in COST_TYPES:
+                    continue
+                if before is not None:
+                    logged = logged_at(row[0])
+                    if logged is None or logged >= before:
+                        continue
+                seconds = parse_duration(row[4])
+                if seconds is None:
+                    continue
+                steps = history.setdefault((row[1].strip(), row[2].strip()), dict())
+                steps.setdefault(COST_TYPES[row[3].strip()], collections.deque(maxlen=keep)).append(seconds)
+    except (IOError, OSError) as e:
+        logger.info('No publishing history at %s: %s' % (csv_path, e))
+    return history
+
+
+# Expected seconds to publish each map: the sum over its steps of the median of their recent durations.  Maps with
+# no history are given the median cost of those with some.
+def map_costs(history, org, map_names):
+    costs = dict()
+    for map_name in map_names:
+        steps = history.get((org, map_name))
+        if steps:
+            costs[map_name] = sum(quantile(sorted(durations), 0.5) for durations in steps.values())
+    known = sorted(costs.values())
+    for map_name in map_names:
+        if map_name not in costs:
+            costs[map_name] = quantile(known, 0.5) if known else DEFAULT_COST
+    return costs
+
+
+# Split maps into n groups of about equal cost: longest first, each to the group with the least cost so far (ties go
+# to the lowest group, and equal costs are taken in name order, so every machine splits the same history the same
+# way).  Returns the groups and their total costs.
+def balance(costs, n):
+    groups = [list() for i in range(n)]
+    totals = [0.0] * n
+    for map_name in sorted(costs, key=lambda m: (-costs[m], m)):
+        lane = totals.index(min(totals))
+        groups[lane].append(map_name)
+        totals[lane] += costs[map_name]
+    return groups, totals
+
+
+# Threads maps are published on at once
+def lanes(options):
+    return options['upload_workers'] if options['pipelined'] else 1
+
+
+# Predicted seconds to publish maps of these costs on n threads
+def predict(costs, n):
+    return max(balance(costs, n)[1]) if costs else 0.0
+
+
+# Print and log a predicted run time up front
+def announce(seconds, count, what='maps'):
+    message = 'Predicted to publish %s %s in %s, finishing around %s' % (
+        count, what, timedelta(seconds=int(seconds)), (datetime.now() + timedelta(seconds=seconds)).strftime('%X'))
+    logger.info(message)
+    print(message)
+
+
+# Collects the timed spans of a run.  Each span is appended to a JSON lines file as it finishes, and the phases the
+# publishing times csv has always covered are written there too.  At the end of the run write_summary turns the last
+# `history` spans of each phase into a Prometheus textfile with per-phase quantiles across runs.
+class Timings(object):
+    def __init__(self, output_file, org, jsonl_path, history=1000):
+        self.output_file = output_file
+        self.org = org
+        self.jsonl_path = jsonl_path
+        self.run_id = time.strftime('%Y%m%d%H%M%S')
+        self.project = None
+        self.spans = list()
+        self._durations = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self._bytes = collections.defaultdict(dict)
+        self._load(history)
+        self._jsonl = open(jsonl_path, 'a')
+        self._lock = threading.Lock()
+
+    # Read the JSON lines history once per run, for write_summary and last_bytes.  The file only needs the last
+    # `history` spans of each phase and each map's last byte count per phase, so once the spans it no longer needs
+    # make up half of it, it is rewritten with just those.  Written to a temporary file and renamed, like the
+    # fingerprint store.
+    def _load(self, history):
+        recent = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        latest = dict()
+        total = 0
+        try:
+            with open(self.jsonl_path, 'r') as f:
+                for total, line in enumerate(f, 1):
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'phase' not in span:
+                        continue
+                    recent[span['phase']].append((total, line))
+                    if self._remember(span):
+                        latest[span['phase'], span['map']] = (total, line)
+        except (IOError, OSError):
+            return
+
+        kept = dict(latest.values())
+        for lines in recent.values():
+            kept.update(lines)
+        if total - len(kept) < len(kept):
+            return
+        try:
+            with open(self.jsonl_path + '.tmp', 'w') as f:
+                f.writelines(kept[number] for number in sorted(kept))
+            os.replace(self.jsonl_path + '.tmp', self.jsonl_path)
+            logger.info('Trimmed %s to %s of %s spans' % (self.jsonl_path, len(kept), total))
+        except (IOError, OSError) as e:
+            logger.error('Could not trim %s: %s' % (self.jsonl_path, e))
+
+    # Add a span to the durations write_summary reports and the byte counts last_bytes returns.  True when the span
+    # is now its map's last byte count for the phase.
+    def _remember(self, span):
+        if span.get('outcome') in ('ok', 'recovered'):
+            self._durations[span['phase']].append(span['seconds'])
+        if span.get('outcome') == 'ok' and span.get('bytes') and not span.get('trimmed'):
+            self._bytes[span['phase']][span['map']] = span['bytes']
+            return True
+        return False
+
+    # Record a finished span.  Upload threads share the files, so everything is written under a lock.
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+            self._remember(span)
+            line = dict(span, run=self.run_id, org=self.org)
+            if self.project is not None:
+                line['project'] = self.project
+            self._jsonl.write(json.dumps(line, sort_keys=True) + '\n')
+            self._jsonl.flush()
+            if span['csv'] and span['outcome'] in ('ok', 'recovered'):
+                self.write_csv(span['map'], span['csv'], timedelta(seconds=span['seconds']))
+                if span['bytes']:
+                    self.write_csv(span['map'], 'Upload MB/s',
+                                   '%.2f' % (span['bytes'] / 1048576.0 / max(span['seconds'], 0.001)))
+
+    # Write one row to the publishing times csv
+    def write_csv(self, map_name, row_type, value):
+        output = str(time.strftime('%X %x')) + ',' + self.org + ',' + str(map_name) + ',' + row_type + ',' + \
+            str(value) + '\n'
+        self.output_file.write(output)
+        self.output_file.flush()
+
+    # Bytes of each map's most recent successful, untrimmed span of phase in the JSON lines history
+    def last_bytes(self, phase):
+        with self._lock:
+            return dict(self._bytes[phase])
+
+    # The same Timings for one project of a multi-project run: spans go to the same logs and span list, tagged with
+    # the project and its organization.
+    def scoped(self, org, project):
+        view = copy.copy(self)
+        view.org = org
+        view.project = project
+        return view
+
+    def close(self):
+        self._jsonl.close()
+
+    # Write p50/p95 duration per phase across the last `history` spans of each phase in the JSON lines history,
+    # plus this run's outcome counts and bytes uploaded, in Prometheus textfile format.  Written to a temporary file
+    # and renamed so the textfile collector never reads a partial file.
+    def write_summary(self, prom_path):
+        with self._lock:
+            durations = dict((phase, list(values)) for phase, values in self._durations.items())
+
+        lines = ['# HELP ago_pro_update_phase_seconds Duration of each publishing phase across runs.',
+                 '# TYPE ago_pro_update_phase_seconds summary']
+        for phase in sorted(durations):
+            values = sorted(durations[phase])
+            for q in (0.5, 0.95):
+                lines.append('ago_pro_update_phase_seconds{phase="%s",quantile="%s"} %.3f' %
+                             (phase, q, quantile(values, q)))
+            lines.append('ago_pro_update_phase_seconds_sum{phase="%s"} %.3f' % (phase, sum(values)))
+            lines.append('ago_pro_update_phase_seconds_count{phase="%s"} %s' % (phase, len(values)))
+
+        outcomes = collections.Counter((span['phase'], span['outcome']) for span in self.spans)
+        lines.append('# HELP ago_pro_update_last_run_spans Phases run in the last run, by outcome.')
+        lines.append('# TYPE ago_pro_update_last_run_spans gauge')
+        for (phase, outcome), count in sorted(outcomes.items()):
+            lines.append('ago_pro_update_last_run_spans{phase="%s",outcome="%s"} %s' % (phase, outcome, count))
+        lines.append('# HELP ago_pro_update_last_run_bytes_uploaded Bytes uploaded in the last run.')
+        lines.append('# TYPE ago_pro_update_last_run_bytes_uploaded gauge')
+        lines.append('ago_pro_update_last_run_bytes_uploaded %s' % sum(span['bytes'] for span in self.spans
+                                                                        if span['phase'] == 'upload'))
+        lines.append('# HELP ago_pro_update_last_run_timestamp_seconds When the last run finished.')
+        lines.append('# TYPE ago_pro_update_last_run_timestamp_seconds gauge')
+        lines.append('ago_pro_update_last_run_timestamp_seconds %d' % time.time())
+
+        with open(prom_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(prom_path + '.tmp', prom_path)
+
+
+# Read the fingerprint of every map as of its last successful publish.  A missing or unreadable store means every map
+# is treated as changed.
+def load_fingerprints(store_path):
+    try:
+        with open(store_path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.info('No usable fingerprint store at %s, all maps will be published: %s' % (store_path, e))
+        return dict()
+
+
+# Write the fingerprint store.  Written to a temporary file first so an interrupted run never leaves a half store.
+def save_fingerprints(store_path, store):
+    with open(store_path + '.tmp', 'w') as f:
+        json.dump(store, f, indent=1, sort_keys=True)
+    os.replace(store_path + '.tmp', store_path)
+
+
+# SHA-256 of a file, read in chunks so large files never sit in memory.
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Files backing one dataset, leaving out lock files, which readers (this script included) touch without editing.  In
+# a file geodatabase a dataset's files are named after its catalog ID (a00000009.gdbtable, .gdbtablx, ...), so edits
+# to other datasets in the same geodatabase do not count; a shapefile's files share its name.
+def dataset_files(path, desc):
+    if os.path.isdir(path):
+        folder, names = path, os.listdir(path)
+        if path.lower().endswith('.gdb') and getattr(desc, 'DSID', None) is not None:
+            prefix = 'a%08x.' % desc.DSID
+            names = [f for f in names if f.lower().startswith(prefix)]
+    else:
+        folder = os.path.dirname(path)
+        prefix = os.path.splitext(os.path.basename(path))[0].lower() + '.'
+        names = [f for f in os.listdir(folder) if f.lower().startswith(prefix)]
+    return [os.path.join(folder, f) for f in names if not f.lower().endswith('.lock')]
+
+
+# Last-modified marker for a layer's data.  Editor tracked data uses its newest edit date; file based data uses the
+# newest modification time of the dataset's own files (see dataset_files).  Enterprise geodatabases without editor
+# tracking have no marker, so only their schema and row count are compared.
+def source_modified(source, desc):
+    if getattr(desc, 'editorTrackingEnabled', False) and desc.editedAtFieldName:
+        field = desc.editedAtFieldName
+        with arcpy.da.SearchCursor(source, [field], sql_clause=(None, 'ORDER BY {} DESC'.format(field))) as cursor:
+            for row in cursor:
+                return str(row[0])
+        return None
+
+    path = source
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    if not path or path.lower().endswith('.sde'):
+        return None
+    return max([os.path.getmtime(f) for f in dataset_files(path, desc)] or [os.path.getmtime(path)])
+
+
+# Fingerprint the data behind every layer and table of a map: data source path, schema, row count and last-modified
+# marker.  Layers without a data source (basemaps, group layers) are left out.
+def layer_fingerprints(pro_map):
+    layers = list()
+    for layer in pro_map.listLayers() + pro_map.listTables():
+        if not layer.supports('DATASOURCE'):
+            continue
+        source = layer.dataSource
+        desc = arcpy.Describe(source)
+        layers.append({'name': layer.name,
+                       'source': source,
+                       'fields': [[f.name, f.type, f.length] for f in arcpy.ListFields(source)],
+                       'count': int(arcpy.management.GetCount(source)[0]),
+                       'modified': source_modified(source, desc)})
+    return layers
+
+
+# First non-null value of a field in order (ASC or DESC), as the hosted service would store it
+def edge_value(layer, field, order):
+    with arcpy.da.SearchCursor(layer, [field], where_clause='{} IS NOT NULL'.format(field),
+                               sql_clause=(None, 'ORDER BY {} {}'.format(field, order))) as cursor:
+        for row in cursor:
+            return service_value(row[0])
+    return None
+
+
+# Extent of a layer's features, merged from their shapes, or None when none has a shape.  The extent a dataset
+# describes only ever grows, so after deletes it is larger than the features it holds.
+def feature_extent(layer):
+    bounds = None
+    with arcpy.da.SearchCursor(layer, ['SHAPE@']) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            extent = row[0].extent
+            if bounds is None:
+                bounds = [extent.XMin, extent.YMin, extent.XMax, extent.YMax]
+            else:
+                bounds = [min(bounds[0], extent.XMin), min(bounds[1], extent.YMin),
+                          max(bounds[2], extent.XMax), max(bounds[3], extent.YMax)]
+    return bounds
+
+
+# Statistics of the data behind every layer and table of a map, to check the published service against: row count,
+# extent of the features and the range of the editor tracking edit date.  Read through the layers, so definition
+# queries apply as they do when publishing.  Layers without a data source are left out, as in layer_fingerprints.
+def layer_statistics(pro_map):
+    layers = list()
+    for layer in pro_map.listLayers() + pro_map.listTables():
+        if not layer.supports('DATASOURCE'):
+            continue
+        desc = arcpy.Describe(layer.dataSource)
+        stats = {'name': layer.name, 'count': int(arcpy.management.GetCount(layer)[0]), 'extent': None,
+                 'wkid': None, 'edit_field': None, 'edit_range': None}
+        if getattr(desc, 'shapeType', None) and stats['count']:
+            stats['extent'] = feature_extent(layer)
+            stats['wkid'] = desc.spatialReference.factoryCode if stats['extent'] is not None else None
+        if getattr(desc, 'editorTrackingEnabled', False) and desc.editedAtFieldName:
+            stats['edit_field'] = desc.editedAtFieldName
+            stats['edit_range'] = [edge_value(layer, desc.editedAtFieldName, 'ASC'),
+                                   edge_value(layer, desc.editedAtFieldName, 'DESC')]
+        layers.append(stats)
+    return layers
+
+
+# Cache key of a staged SD: a hash of the exported SD Draft and the fingerprints of the data behind the map, which
+# together determine what staging produces.
+def sd_cache_key(fingerprint):
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Path of a map's cached SD for key, or None on a miss.  A hit marks the entry as recently used for eviction.
+def sd_cache_get(cache, key, map_name):
+    entry = os.path.join(cache['directory'], key)
+    path = os.path.join(entry, map_name + '.sd')
+    if not os.path.isfile(path):
+        return None
+    os.utime(entry, None)
+    return path
+
+
+# Move a freshly staged SD into the cache under key and return its new path.  The entry is filled under a temporary
+# name and renamed into place, so other staging processes never see a partial entry.  SD files larger than the whole
+# cache are left where they are.
+def sd_cache_put(cache, key, sd):
+    if os.path.getsize(sd) > cache['max_mb'] * 1048576:
+        return sd
+    entry = os.path.join(cache['directory'], key)
+    partial = '%s.%s.partial' % (entry, os.getpid())
+    os.makedirs(partial, exist_ok=True)
+    shutil.move(sd, os.path.join(partial, os.path.basename(sd)))
+    try:
+        os.rename(partial, entry)
+    except OSError:
+        # Another process cached the same SD first
+        shutil.rmtree(partial, ignore_errors=True)
+    return os.path.join(entry, os.path.basename(sd))
+
+
+# Trim the SD cache after a run: entries unused for longer than max_age_days are removed, then the least recently
+# used ones until the cache fits in max_mb.  Leftover partial entries from crashed runs are removed too.
+def evict_sd_cache(cache):
+    directory = cache['directory']
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    entries = list()
+    for name in os.listdir(directory):
+        entry = os.path.join(directory, name)
+        if name.endswith('.partial'):
+            if now - os.path.getmtime(entry) > 86400:
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+
+    kept = 0
+    removed = 0
+    for used, size, entry in sorted(entries, reverse=True):
+        if now - used > cache['max_age_days'] * 86400 or kept + size > cache['max_mb'] * 1048576:
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+        else:
+            kept += size
+    logger.info('SD cache: %s entries, %.1f MB kept, %s evicted' % (len(entries) - removed, kept / 1048576.0,
+                                                                    removed))
+
+
+# Trim settings of a map that change what it publishes, recorded in its fingerprint
+def trim_settings(trim):
+    return dict((k, trim[k]) for k in ('drop_fields', 'drop_hidden_fields', 'scale_limit', 'tolerance_mm'))
+
+
+# Generalization tolerance in meters: the ground distance tolerance_mm of paper covers at the scale limit, which is
+# too small to see at any scale the layer may be used at.  0.2 mm at 1:2400 is about half a meter.
+def trim_tolerance(trim):
+    return trim['scale_limit'] * trim['tolerance_mm'] / 1000.0
+
+
+# Fields a layer or table hides in the map.  Hidden fields are not shown by the published layer either.
+def hidden_fields(layer):
+    try:
+        definition = layer.getDefinition('V2')
+    except (AttributeError, RuntimeError, ValueError):
+        return []
+    table = getattr(definition, 'featureTable', None) or definition
+    return [d.fieldName for d in getattr(table, 'fieldDescriptions', None) or [] if not d.visible]
+
+
+# Copy every layer and table of a map into a scratch geodatabase (Trim_<map>.gdb in rel_path), drop the configured
+# and hidden fields, generalize lines and polygons to trim_tolerance and point the map at the copies.  Copies are
+# made from the layers, so definition queries carry over; layers with joins are left alone.  Returns the connection
+# properties to restore with restore_map and a report of what was trimmed, with warnings for the layers left alone.
+def trim_map(pro_map, map_name, rel_path, trim):
+    gdb_name = 'Trim_%s.gdb' % re.sub(r'\W', '_', map_name)
+    gdb = os.path.join(rel_path, gdb_name)
+    if arcpy.Exists(gdb):
+        arcpy.management.Delete(gdb)
+    arcpy.management.CreateFileGDB(rel_path, gdb_name)
+    tolerance = trim_tolerance(trim)
+    drop_configured = set(f.lower() for f in trim['drop_fields'])
+    restore = list()
+    report = {'layers': 0, 'fields_dropped': 0, 'tolerance_m': tolerance, 'warnings': list()}
+    try:
+        for number, layer in enumerate(pro_map.listLayers() + pro_map.listTables()):
+            if not layer.supports('DATASOURCE'):
+                continue
+            original = layer.connectionProperties
+            if 'source' in original:
+                report['warnings'].append('"%s" in %s has a join and is published untrimmed' %
+                                          (layer.name, map_name))
+                continue
+            desc = arcpy.Describe(layer.dataSource)
+            dataset = 'T%03d' % number
+            output = os.path.join(gdb, dataset)
+            shape_type = getattr(desc, 'shapeType', None)
+            if shape_type:
+                arcpy.management.CopyFeatures(layer, output)
+            else:
+                arcpy.management.CopyRows(layer, output)
+
+            hidden = set(f.lower() for f in hidden_fields(layer)) if trim['drop_hidden_fields'] else set()
+            drop = [f.name for f in arcpy.ListFields(output)
+                    if not f.required and f.type not in SYSTEM_FIELDS and f.name.lower() in drop_configured | hidden]
+            if drop:
+                arcpy.management.DeleteField(output, drop)
+            if shape_type in ('Polyline', 'Polygon') and tolerance > 0:
+                arcpy.edit.Generalize(output, '%s Meters' % tolerance)
+
+            layer.updateConnectionProperties(original, {'connection_info': {'database': gdb}, 'dataset': dataset,
+                                                        'workspace_factory': 'File Geodatabase'})
+            restore.append((layer, original))
+            report['layers'] += 1
+            report['fields_dropped'] += len(drop)
+    except Exception:
+        restore_map(restore)
+        raise
+    return restore, report
+
+
+# Point the layers trim_map moved to its copies back at their own data
+def restore_map(restore):
+    for layer, original in restore:
+        layer.updateConnectionProperties(layer.connectionProperties, original)
+
+
+# Create the SD Draft and stage the Service Definition for one map.  Runs inside the staging process pool, so it only
+# takes picklable arguments and re-opens the project by path.  Errors are returned rather than raised so one bad map
+# does not stop the rest of the run, and warnings are returned for run_maps to log, as a staging process started with
+# spawn (Windows) has no log handlers of its own.  When the map's fingerprint matches the one it was last published
+# with, staging is skipped and the result is flagged as unchanged.  Maps in sync mode are fingerprinted but not staged;
+# their edits are pushed by sync_map instead.  With a cache, an SD staged earlier from the same draft and data is
+# reused.  With trim (the map's options), the SD is staged from a trimmed copy of the map's data; see trim_map.  With
+# service_name, the SD publishes a service of that name (a blue/green backing service) rather than one named after the
+# map.  With verify, statistics of the map's data are gathered to check the published service against (see
+# verify_service).  portal is the (url, user, password) of the job's portal, which the staging process signs into
+# first; projects of several configs share the staging processes, so it can differ from one map to the next.
+def stage_map(project_path, map_name, rel_path, previous=None, force=False, mode='overwrite', cache=None,
+              trim=None, service_name=None, verify=False, portal=None):
+    spans = list()
+    result = {'map': map_name, 'sd': None, 'error': None, 'fingerprint': None, 'unchanged': False, 'sync': False,
+              'sd_hash': None, 'reuse': False, 'trim': None, 'service': service_name or map_name, 'stats': None,
+              'spans': spans, 'warnings': list()}
+
+    # Set variables for sd draft and sd
+    draftName = map_name + '.sddraft'
+    sdName = map_name + '.sd'
+    sddraft = os.path.join(rel_path, draftName)
+    sd = os.path.join(rel_path, sdName)
+    sd_fs_name = map_name
+
+    if portal is not None:
+        try:
+            arcpy_sign_in(*portal)
+        except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+            result['error'] = 'Could not sign into %s: %s' % (portal[0], e)
+            return result
+
+    try:
+        pro_map = open_project(project_path).listMaps(map_name)[0]
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning, IndexError) as e:
+        result['error'] = 'Could not find map "%s" in project: %s' % (map_name, e)
+        return result
+
+    # Create SD Draft
+    try:
+        with timed(spans.append, map_name, 'draft'):
+            sharing_draft = pro_map.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", sd_fs_name)
+        # Legacy
+        # The arcpy.sharing module was introduced at ArcGIS Pro 2.2 to provide a better experience when
+        # sharing web layers over the previously existing function CreateWebLayerSDDraft.
+        # arcpy.mp.CreateWebLayerSDDraft(pro_map, sddraft, sd_fs_name,'MY_HOSTED_SERVICES','FEATURE_ACCESS',
+        # True, True)
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+        result['error'] = 'Could not create sharing draft: %s' % e
+        return result
+
+    # Export SD Draft
+    try:
+        with timed(spans.append, map_name, 'export_sddraft'):
+            sharing_draft.exportToSDDraft(sddraft)
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+        result['error'] = 'Could not create SDDraft. Check permissions to script folder: %s' % e
+        return result
+
+    # Fingerprint the map's data and draft, and stop here if nothing changed since the last publish
+    try:
+        with timed(spans.append, map_name, 'fingerprint') as span:
+            result['fingerprint'] = {'layers': layer_fingerprints(pro_map), 'sddraft': file_hash(sddraft)}
+            if trim is not None:
+                result['fingerprint']['trim'] = trim_settings(trim)
+            if not force and previous is not None and result['fingerprint'] == previous:
+                span['outcome'] = 'unchanged'
+                result['unchanged'] = True
+                return result
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning, IOError, OSError) as e:
+        result['warnings'].append('Could not fingerprint "%s", it will be published: %s' % (map_name, e))
+    if mode == 'sync':
+        result['sync'] = True
+        return result
+
+    if verify:
+        try:
+            with timed(spans.append, map_name, 'statistics'):
+                result['stats'] = layer_statistics(pro_map)
+        except (arcpy.ExecuteError, arcpy.ExecuteWarning, RuntimeError) as e:
+            result['warnings'].append('Could not gather statistics of "%s", its service is only checked for '
+                                      'layers: %s' % (map_name, e))
+
+    # Reuse an SD staged from the same draft and data.  The map is fingerprinted under its own name, so a blue/green
+    # map is unchanged whichever backing service it goes to next, but its SD is cached per service.  A forced run, or
+    # data with no modified marker to tell its edits apart, is always staged and uploaded afresh.
+    if result['fingerprint'] is not None:
+        if result['service'] != map_name:
+            result['sd_hash'] = sd_cache_key(dict(result['fingerprint'], service=result['service']))
+        else:
+            result['sd_hash'] = sd_cache_key(result['fingerprint'])
+        result['reuse'] = not force and all(layer.get('modified') is not None
+                                            for layer in result['fingerprint']['layers'])
+    if cache is not None and result['reuse']:
+        cached = sd_cache_get(cache, result['sd_hash'], map_name)
+        if cached is not None:
+            with timed(spans.append, map_name, 'stage') as span:
+                span['outcome'] = 'cached'
+            result['sd'] = cached
+            return result
+
+    # Draft the SD again from a trimmed copy of the data, or for the service it publishes.  If trimming fails the
+    # map is published untrimmed.
+    sd_fs_name = result['service']
+    redraft = sd_fs_name != map_name
+    if trim is not None:
+        try:
+            with timed(spans.append, map_name, 'trim'):
+                restore, result['trim'] = trim_map(pro_map, map_name, rel_path, trim)
+                result['warnings'].extend(result['trim']['warnings'])
+                try:
+                    pro_map.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", sd_fs_name).exportToSDDraft(sddraft)
+                    redraft = False
+                finally:
+                    restore_map(restore)
+        except (arcpy.ExecuteError, arcpy.ExecuteWarning, IOError, OSError) as e:
+            result['warnings'].append('Could not trim "%s", publishing it untrimmed: %s' % (map_name, e))
+            result['trim'] = None
+            redraft = True
+    if redraft:
+        try:
+            pro_map.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", sd_fs_name).exportToSDDraft(sddraft)
+        except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+            result['error'] = 'Could not create SDDraft. Check permissions to script folder: %s' % e
+            return result
+
+    # Stage service in temporary location
+    try:
+        with timed(spans.append, map_name, 'stage') as span:
+            arcpy.StageService_server(sddraft, sd)
+            span['bytes'] = os.path.getsize(sd)
+            if result['trim'] is not None:
+                span['trimmed'] = True
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+        result['error'] = 'Could not stage service. Check staging location: %s' % e
+        return result
+
+    if cache is not None and result['sd_hash'] is not None:
+        try:
+            sd = sd_cache_put(cache, result['sd_hash'], sd)
+        except (IOError, OSError) as e:
+            result['warnings'].append('Could not cache the SD of "%s": %s' % (map_name, e))
+    result['sd'] = sd
+    return result
+
+
+# Type keywords of a Service Definition item holding the SD with cache key sd_hash
+def sd_keywords(keywords, sd_hash):
+    keywords = [k for k in split_list(keywords) if not k.startswith(SD_HASH_KEYWORD)]
+    if sd_hash is not None:
+        keywords.append(SD_HASH_KEYWORD + sd_hash)
+    return ','.join(keywords)
+
+
+# Find the map's SD and overwrite its data, or add it as a new item.  The item is tagged with the SD's cache key, so
+# an item that already holds the same SD (say, after a publish that failed) is not uploaded again, unless reuse is
+# off (see stage_map).  Runs inside the upload thread pool.  title is the service the SD publishes, when not named
+# after the map.  Returns the Service Definition item, or None when it could not be uploaded.
+def upload_map(gis, map_name, sd, settings, timings, sd_hash=None, title=None, reuse=True):
+    sd_fs_name = title or map_name
+    retry = settings['retry']
+
+    sdItem = settings['index'].get(sd_fs_name, 'Service Definition')
+    if sdItem is None:
+        logger.info('Item is not published...')
+        print('Item is not published...')
+        return add_sd(gis, map_name, sd, settings, timings, sd_hash, sd_fs_name)
+
+    if reuse and sd_hash is not None and SD_HASH_KEYWORD + sd_hash in split_list(sdItem.typeKeywords):
+        logger.info('%s already holds this Service Definition, skipping the upload.' % sd_fs_name)
+        print('%s already holds this Service Definition, skipping the upload.' % sd_fs_name)
+        with timed(timings.record, map_name, 'upload') as span:
+            span['outcome'] = 'unchanged'
+        return sdItem
+
+    logger.info('Uploading new Service Definition...')
+    print('Uploading new Service Definition...')
+    keywords = sd_keywords(sdItem.typeKeywords, sd_hash)
+    with timed(timings.record, map_name, 'upload', 'Overwriting SD File') as span:
+        span['bytes'] = os.path.getsize(sd)
+        if use_multipart(sd, settings):
+            multipart_upload(gis, settings, sd, item_id=sdItem.id, span=span, keywords=keywords)
+        else:
+            retry.call(lambda: sdItem.update(item_properties={'typeKeywords': keywords}, data=sd),
+                       'Upload of %s' % sd, span)
+    return sdItem
+
+
+# Metadata given to services whose item was published without it
+def service_metadata(map_name, settings):
+    sd_fs_name = map_name
+
+    # Define metadata
+    service_snippet = '{} in York County, PA.'.format(sd_fs_name)
+    service_description = '{} in York County. Intended for illustration and demonstration purposes only.'.format(sd_fs_name)
+    service_terms_of_use = 'FOR PUBLIC DISTRIBUTION. Layer should not be used at scales larger than 1:2400'
+    service_credits = 'York County Planning Commission (YCPC)'
+    service_tags = ['Open Data', '{}'.format(settings['open_cat'])]
+
+    # Create update dict
+    item_properties = {'snippet': service_snippet,
+                       'description': service_description,
+                       'licenseInfo': service_terms_of_use,
+                       'accessInformation': service_credits,
+                       'tags': service_tags}
+    return item_properties
+
+
+# Split a comma separated config value into a list
+def split_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+
+# Read a True/False config value
+def as_bool(value):
+    return str(value).strip().lower() in ('true', 'yes', '1')
+
+
+# Service definition properties from option_dict that differ from the service's current ones.  Capabilities are
+# compared as a set, so their order does not matter.
+def definition_changes(properties, option_dict):
+    changes = dict()
+    for key, value in option_dict.items():
+        current = properties.get(key)
+        if key == 'capabilities':
+            same = set(split_list(current)) == set(split_list(value))
+        else:
+            same = current == value
+        if not same:
+            changes[key] = value
+    return changes
+
+
+# Sharing the config asks for that the item does not have yet.  Returns the arguments for Item.share, or None when
+# the item is already shared as configured.
+def sharing_changes(fs, settings, shared_groups):
+    everyone = as_bool(settings['shrEveryone'])
+    org = as_bool(settings['shrOrg'])
+    access = 'public' if everyone else 'org' if org else None
+    missing = [g for g in split_list(settings['shrGroups']) if g not in shared_groups]
+    if (access is None or fs.access == access) and not missing:
+        return None
+    return {'org': settings['shrOrg'], 'everyone': settings['shrEveryone'], 'groups': settings['shrGroups']}
+
+
+# Metadata to fill in on an item.  Only items with an empty description, tags or license are touched, and then only
+# the properties that differ.
+def metadata_changes(fs, item_properties):
+    # If Statement on fs items
+    # Update properties if AGOL item are empty ('' or null). If not, ignore update items.
+    # This will essentially provide information to AGOL item if no information is provided.
+    # This is my alternative because I should not get fs.properties working on my AGOL.
+    # fs.properties mentions that there is no values for some reason
+    if fs.description is not None and fs.tags is not None and fs.licenseInfo is not None:
+        return dict()
+    return dict((key, value) for key, value in item_properties.items() if getattr(fs, key, None) != value)
+
+
+# Bring a published service's capabilities, sharing and metadata in line with the config.  The service definition
+# (and the item's groups, when groups are configured) is read once and only the calls for what differs are sent,
+# so a service that already matches costs no updates.  Runs for all published maps together at the end of the run.
+# Returns True, or False when the service could not be brought in line, so the map is not recorded as published and
+# is published again next run.
+def reconcile_service(gis, fs, map_name, settings, timings):
+    sd_fs_name = map_name
+    retry = settings['retry']
+    try:
+        with timed(timings.record, map_name, 'reconcile') as span:
+            flc = arcgis.features.FeatureLayerCollection(fs.url, gis)
+            properties = retry.call(lambda: flc.properties, 'Service definition lookup', span)
+            shared_groups = set()
+            if split_list(settings['shrGroups']):
+                shared = retry.call(lambda: fs.shared_with, 'Sharing lookup', span)
+                shared_groups = set(getattr(g, 'id', g) for g in shared.get('groups', []))
+            definition = definition_changes(properties, settings['option_dict'])
+            sharing = sharing_changes(fs, settings, shared_groups)
+            item_properties = metadata_changes(fs, service_metadata(map_name, settings))
+
+        # Update Capabilities
+        if definition:
+            with timed(timings.record, map_name, 'update_definition') as span:
+                retry.call(lambda: flc.manager.update_definition(definition), 'Capabilities update', span)
+            logger.info('Added capabilities to service: %s' % definition)
+        else:
+            logger.info('Capabilities of %s already match' % sd_fs_name)
+
+        if sharing:
+            with timed(timings.record, map_name, 'share') as span:
+                retry.call(lambda: fs.share(**sharing), 'Sharing', span)
+            logger.info('Sharing: Org: %s, Everyone: %s, Groups: %s' % (settings['shrOrg'], settings['shrEveryone'],
+                                                                        settings['shrGroups']))
+            print('Sharing: Org: %s, Everyone: %s, Groups: %s' % (settings['shrOrg'], settings['shrEveryone'],
+                                                                  settings['shrGroups']))
+        else:
+            logger.info('Sharing of %s already matches' % sd_fs_name)
+
+        if item_properties:
+            print('AGOL Items are empty. Updating Item Properties for %s' % (sd_fs_name))
+            logger.info('AGOL Items are empty. Updating Item Properties for %s: %s' % (sd_fs_name,
+                                                                                      sorted(item_properties)))
+            with timed(timings.record, map_name, 'metadata') as span:
+                retry.call(lambda: fs.update(item_properties), 'Metadata update', span)
+        else:
+            print("AGOL Item is not empty")
+            logger.info('AGOL Item is not empty for %s' % (sd_fs_name))
+
+        logger.info('{}'.format(fs.tags))
+        print('{}'.format(fs.tags))
+
+    except Exception as e:
+        logger.error('Could not share service: %s' % e)
+        print('Could not share service "%s": %s' % (sd_fs_name, e))
+        return False
+
+    logger.info('-* Layer "%s" has been published. *-' % map_name)
+    print('-* Layer "%s" has been published. *-' % map_name)
+    return True
+
+
+# Title of the service a view shows, from its Service2Service relationship, or None when it has none
+def view_source(view, retry, span=None):
+    related = retry.call(lambda: view.related_items('Service2Service', 'reverse'), 'View source lookup', span)
+    return related[0].title if related else None
+
+
+# Backing service a blue/green map publishes to next: <map>_Blue or <map>_Green, whichever its live view (the
+# service titled after the map) does not show.  What the view shows is looked up rather than taken from its
+# bluegreen: keyword, which is written after the swap and can lag behind it.  Returns None when the map is still
+# published as a plain service, which has to be renamed or removed before the map can switch to blue/green.  Raises
+# RuntimeError when the view shows neither backing service, as publishing over either could take it offline.
+def bluegreen_service(index, map_name, retry):
+    live = index.get(map_name, 'Feature Service')
+    if live is None:
+        return '%s_%s' % (map_name, BLUEGREEN_COLORS[0])
+    if 'View Service' not in split_list(live.typeKeywords):
+        return None
+    source = view_source(live, retry)
+    services = ['%s_%s' % (map_name, color) for color in BLUEGREEN_COLORS]
+    if source not in services:
+        raise RuntimeError('the live view of "%s" shows %s, not %s' % (map_name, source, ' or '.join(services)))
+    return services[1 - services.index(source)]
+
+
+# Differences between one hosted layer and the statistics of its local data.  The count and extent come back from
+# one query; the edit date range takes a statistics query, sent only when the hosted layer has the field.
+def layer_mismatches(layer, stats, verify, retry, span):
+    name = stats['name']
+    if stats['extent'] is not None:
+        result = retry.call(lambda: layer.query(return_count_only=True, return_extent_only=True,
+                                                out_sr=stats['wkid']), 'Count query', span)
+        count, extent = result['count'], result.get('extent')
+    else:
+        count = retry.call(lambda: layer.query(return_count_only=True), 'Count query', span)
+        extent = None
+
+    problems = list()
+    if count != stats['count']:
+        problems.append('"%s" has %s rows, %s locally' % (name, count, stats['count']))
+    if extent:
+        local = stats['extent']
+        allowed = max(local[2] - local[0], local[3] - local[1]) * verify['extent_tolerance']
+        hosted = [extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax']]
+        if any(abs(h - l) > allowed for h, l in zip(hosted, local)):
+            problems.append('"%s" covers %s, %s locally' % (name, hosted, local))
+
+    fields = [f['name'] for f in getattr(layer.properties, 'fields', None) or []]
+    if stats['edit_field'] in fields and stats['edit_range'][1] is not None:
+        field = stats['edit_field']
+        result = retry.call(lambda: layer.query(out_statistics=[
+            {'statisticType': 'min', 'onStatisticField': field, 'outStatisticFieldName': 'edit_min'},
+            {'statisticType': 'max', 'onStatisticField': field, 'outStatisticFieldName': 'edit_max'}]),
+            'Statistics query', span)
+        attributes = result.features[0].attributes if result.features else dict()
+        hosted = [attributes.get('edit_min'), attributes.get('edit_max')]
+        if any(l is not None and (h is None or abs(h - l) > verify['date_tolerance_ms'])
+               for h, l in zip(hosted, stats['edit_range'])):
+            problems.append('"%s" was edited %s, %s locally' % (name, hosted, stats['edit_range']))
+    return problems
+
+
+# Check a published service against the statistics of the data it was published from (from stage_map): each local
+# layer must have a hosted layer (matched by name, else by position) with the same row count, extent and edit date
+# range.  Without statistics, the service only has to have layers that answer a count query.  Mismatches are logged
+# and recorded on the verify span.  Returns True when the service matches.
+def verify_service(gis, fs, map_name, stats, settings, timings, verify):
+    retry = settings['retry']
+    with timed(timings.record, map_name, 'verify') as span:
+        try:
+            flc = arcgis.features.FeatureLayerCollection(fs.url, gis)
+            hosted = flc.layers + flc.tables
+            names = [layer.properties.name for layer in hosted]
+            problems = list()
+            if not hosted:
+                problems.append('%s has no layers' % fs.title)
+            elif stats is None:
+                for layer in hosted:
+                    retry.call(lambda: layer.query(return_count_only=True), 'Count query', span)
+            for position, layer_stats in enumerate(stats or []):
+                if layer_stats['name'] in names:
+                    layer = hosted[names.index(layer_stats['name'])]
+                elif position < len(hosted):
+                    layer = hosted[position]
+                else:
+                    problems.append('"%s" is missing' % layer_stats['name'])
+                    continue
+                problems.extend(layer_mismatches(layer, layer_stats, verify, retry, span))
+        except Exception as e:
+            problems = ['%s does not answer queries: %s' % (fs.title, e)]
+        if problems:
+            span['outcome'] = 'mismatch'
+            span['mismatches'] = problems
+            logger.error('%s does not match the data it was published from: %s' % (fs.title, '; '.join(problems)))
+            print('%s does not match the data it was published from.' % fs.title)
+            return False
+    logger.info('Verified %s against the data of "%s"' % (fs.title, map_name))
+    return True
+
+
+# Switch a blue/green map's consumers to the backing service just published (fs).  A view of fs is swapped in for
+# the live view with replace_service, which keeps the live view's item id and URL; the view it replaces is kept as
+# <map>_Previous for rollback, in place of the one kept last time.  The first publish creates the live view.  The
+# view is then labelled with a bluegreen: keyword for people looking at it; bluegreen_service does not rely on it.
+# Runs inside the upload thread pool.  Returns the live view, or None when fs failed verification or could not be
+# swapped in, in which case consumers stay where they were.  stats and verify are those of verify_service.
+def swap_view(gis, fs, map_name, stats, settings, timings, verify):
+    index = settings['index']
+    retry = settings['retry']
+    live = index.get(map_name, 'Feature Service')
+    if not verify_service(gis, fs, map_name, stats, settings, timings, verify):
+        return None
+
+    color = fs.title[len(map_name) + 1:]
+    staging_title = '%s_Next' % map_name
+    previous_title = '%s_Previous' % map_name
+    swapped = False
+    try:
+        with timed(timings.record, map_name, 'swap', 'Swapping View') as span:
+            manager = arcgis.features.FeatureLayerCollection(fs.url, gis).manager
+            if live is None:
+                live = retry.call(lambda: manager.create_view(name=map_name), 'View creation', span)
+            else:
+                for title in (staging_title, previous_title):
+                    stale = index.get(title, 'Feature Service')
+                    if stale is not None:
+                        retry.call(stale.delete, 'Removal of %s' % title, span)
+                        index.discard(title, 'Feature Service')
+                view = retry.call(lambda: manager.create_view(name=staging_title), 'View creation', span)
+                retry.call(lambda: gis.content.replace_service(live, view, replaced_service_name=previous_title),
+                           'View swap', span)
+                # The new view is taken into the live one; the view it replaced is kept as previous_title
+                index.discard(staging_title, 'Feature Service')
+                index.expect(previous_title, 'Feature Service')
+            swapped = True
+            index.put(live)
+            keywords = [k for k in split_list(live.typeKeywords) if not k.startswith(BLUEGREEN_KEYWORD)]
+            retry.call(lambda: live.update(item_properties={'typeKeywords': ','.join(keywords + [BLUEGREEN_KEYWORD +
+                                                                                                  color])}),
+                       'View keywords', span)
+    except Exception as e:
+        # A retried replace_service can fail after an earlier attempt went through: ask the view what it shows
+        if not swapped and live is not None:
+            try:
+                swapped = view_source(live, retry) == fs.title
+            except Exception:
+                pass
+        if not swapped:
+            logger.error('Could not swap %s in for "%s", consumers stay on the live view: %s' %
+                         (fs.title, map_name, e))
+            print('**' + str(e) + '**')
+            return None
+        logger.error('Swapped %s in for "%s", but its keywords were not updated: %s' % (fs.title, map_name, e))
+        print('"%s" now shows %s; its keywords were not updated.' % (map_name, fs.title))
+        return live
+
+    logger.info('"%s" now shows %s; the view it replaced is kept as %s.' % (map_name, fs.title, previous_title))
+    print('"%s" now shows %s.' % (map_name, fs.title))
+    return live
+
+
+# Add a map's SD to the org as a new item, titled title or after the map, when no existing Service Definition was
+# found.
+def add_sd(gis, map_name, sd, settings, timings, sd_hash=None, title=None):
+    title = title or map_name
+    logger.info('Uploading new Service Definition...')
+    print('Uploading new Service Definition...')
+    keywords = sd_keywords([], sd_hash)
+    try:
+        with timed(timings.record, map_name, 'upload', 'Add New SD') as span:
+            span['bytes'] = os.path.getsize(sd)
+            if use_multipart(sd, settings):
+                item_id = multipart_upload(gis, settings, sd, title=title, span=span, keywords=keywords)
+                sdItem = settings['retry'].call(lambda: gis.content.get(item_id), 'Lookup of %s' % sd, span)
+            else:
+                sdItem = settings['retry'].call(lambda: gis.content.add({'title': title,
+                                                                         'typeKeywords': keywords}, data=sd,
+                                                                        folder=settings['agol_folder']),
+                                                'Upload of %s' % sd, span)
+        settings['index'].put(sdItem)
+    except ValueError as e:
+        logger.critical('Could not add service %s to Org' % title)
+        logger.critical('Make sure you are signed into ArcGIS Pro. Save password if closing.')
+        return None
+    return sdItem
+
+
+# REST url of the portal and the token of the signed in user, for calls the arcgis module does not expose.
+def rest_endpoint(gis):
+    return gis._portal.resturl, gis._con.token
+
+
+# Pooled HTTP session for direct REST calls to a portal as one user.  Sized for parallel part uploads.  Calls made
+# through rest_post wait on limiter.
+def rest_session(rest_url, user, pool_size=10, limiter=None):
+    with _sessions_lock:
+        if (rest_url, user) not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[(rest_url, user)] = session
+        _sessions[(rest_url, user)].limiter = limiter
+        return _sessions[(rest_url, user)]
+
+
+# POST to the portal REST api and return the json response.  Raises RuntimeError when the portal reports an error.
+def rest_post(session, url, token, data, files=None):
+    data = dict(data, f='json', token=token)
+    response = throttled(getattr(session, 'limiter', None), session.post, url, data=data, files=files, timeout=600)
+    response.raise_for_status()
+    result = response.json()
+    if 'error' in result or result.get('success') is False:
+        raise RuntimeError('%s: %s' % (url, result.get('error', result)))
+    return result
+
+
+# True when a SD file is large enough to upload in parts.
+def use_multipart(sd, settings):
+    return os.path.getsize(sd) >= settings['upload']['multipart_mb'] * 1048576
+
+
+# Remove the item a multipart add created, once its upload is given up.  An upload to an existing item leaves the
+# item alone.  Failing to remove it is only logged; the item is an empty SD in the publishing folder.
+def discard_upload(session, user_url, token, state, item_id):
+    if item_id is not None or state['item_id'] is None:
+        return
+    try:
+        rest_post(session, '{}/items/{}/delete'.format(user_url, state['item_id']), token, {})
+    except RETRYABLE + (RuntimeError,) as e:
+        logger.warning('Could not remove the unfinished upload item %s: %s' % (state['item_id'], e))
+
+
+# Upload a SD file in parts: start a multipart add (new item) or update (item_id), send the parts in parallel, then
+# commit.  Finished parts are recorded in <sd>.upload.json, so a retry after a dropped connection, or the next run
+# after a crash, only sends the parts still missing, as long as the SD file itself has not changed.  An error from
+# the portal itself starts the upload over instead.  Returns the id
+# of the item holding the upload, and counts the attempts that had to be retried on span.  keywords, when given,
+# become the item's type keywords on commit.
+def multipart_upload(gis, settings, sd, item_id=None, title=None, span=None, keywords=None):
+    upload = settings['upload']
+    rest_url, token = rest_endpoint(gis)
+    session = rest_session(rest_url, settings['user'], upload['parallel_parts'], settings['retry'].limiter)
+    user_url = '{}content/users/{}'.format(rest_url, settings['user'])
+    part_size = int(upload['part_mb'] * 1048576)
+    size = os.path.getsize(sd)
+    parts = list(range(1, int(math.ceil(size / float(part_size))) + 1))
+    state_path = sd + '.upload.json'
+    state_lock = threading.Lock()
+
+    # Pick up a previous attempt at the same file, or start over
+    expected = {'item_id': item_id, 'size': size, 'mtime': os.path.getmtime(sd), 'part_size': part_size}
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if any(state.get(k) != v for k, v in expected.items() if not (k == 'item_id' and v is None)):
+            state = None
+    except (IOError, OSError, ValueError):
+        state = None
+    if state is None:
+        state = dict(expected, started=False, done=[])
+    else:
+        logger.info('Resuming upload of %s: %s of %s parts already sent' % (sd, len(state['done']), len(parts)))
+
+    def save_state():
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+    def send_part(part):
+        with open(sd, 'rb') as f:
+            f.seek((part - 1) * part_size)
+            chunk = f.read(part_size)
+        rest_post(session, '{}/items/{}/addPart'.format(user_url, state['item_id']), token, {'partNum': part},
+                  files={'file': (os.path.basename(sd), chunk)})
+        with state_lock:
+            state['done'].append(part)
+            save_state()
+
+    retry = settings['retry']
+    for attempt in range(retry.attempts):
+        try:
+            if not state['started']:
+                params = {'multipart': 'true', 'filename': os.path.basename(sd)}
+                if state['item_id'] is None:
+                    folder_id = settings['index'].folders.get(settings['agol_folder'])
+                    folder_url = user_url + ('/' + folder_id if folder_id else '')
+                    params.update({'type': 'Service Definition', 'title': title})
+                    state['item_id'] = rest_post(session, folder_url + '/addItem', token, params)['id']
+                else:
+                    rest_post(session, '{}/items/{}/update'.format(user_url, state['item_id']), token, params)
+                state['started'] = True
+                save_state()
+
+            missing = [p for p in parts if p not in state['done']]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=upload['parallel_parts']) as pool:
+                errors = [f.exception() for f in [pool.submit(send_part, p) for p in missing]]
+            errors = [e for e in errors if e is not None]
+            if errors:
+                raise errors[0]
+            break
+        except RETRYABLE + (RuntimeError,) as e:
+            logger.warning('Upload of %s interrupted (attempt %s), %s of %s parts sent: %s' %
+                           (sd, attempt + 1, len(state['done']), len(parts), e))
+            if span is not None:
+                span['retries'] += 1
+            # The portal turned the upload down (an expired or unknown upload, say) rather than the connection
+            # dropping: sending the missing parts again would fail the same way, so start a fresh upload
+            if isinstance(e, RuntimeError) and state['started']:
+                logger.warning('Starting the upload of %s over' % sd)
+                discard_upload(session, user_url, token, state, item_id)
+                state = dict(expected, started=False, done=[])
+                os.remove(state_path)
+            time.sleep(retry.delay(attempt))
+    else:
+        raise RuntimeError('Could not upload %s after %s attempts' % (sd, retry.attempts))
+
+    # Assemble the parts and wait for the portal to finish processing the file
+    commit = {'type': 'Service Definition'}
+    if keywords is not None:
+        commit['typeKeywords'] = keywords
+    try:
+        rest_post(session, '{}/items/{}/commit'.format(user_url, state['item_id']), token, commit)
+    except RuntimeError:
+        os.remove(state_path)
+        raise
+    status_url = '{}/items/{}/status'.format(user_url, state['item_id'])
+    for poll in range(120):
+        status = rest_post(session, status_url, token, {}).get('status')
+        if status == 'completed':
+            break
+        if status == 'failed':
+            os.remove(state_path)
+            raise RuntimeError('Portal could not process the upload of %s' % sd)
+        time.sleep(settings['poll'].delay(poll))
+    else:
+        raise RuntimeError('Portal did not finish processing the upload of %s' % sd)
+    os.remove(state_path)
+    logger.info('Uploaded %s in %s parts' % (sd, len(parts)))
+    return state['item_id']
+
+
+# Publishes services as portal jobs and follows them from one asyncio event loop on a background thread, so the jobs
+# of many maps are polled concurrently without holding an upload thread each.  A job is submitted once: when the
+# service already has a publish job in progress it is followed instead, and when a submit times out the service is
+# checked for a job the lost request may have started before anything is submitted again.  Status polls back off
+# on the poll schedule; submits and polls that drop their connection are retried on the retry schedule.
+class PublishMonitor(object):
+    def __init__(self, retry, poll, timeout):
+        self.retry = retry
+        self.poll = poll
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='PublishMonitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Publish a map's Service Definition with overwrite.  title is the service's, when not named after the map.
+    # Returns a concurrent.futures.Future that resolves to the feature service item, or None when publishing failed.
+    def publish(self, gis, sd_item, map_name, settings, timings, title=None):
+        return asyncio.run_coroutine_threadsafe(self._publish(gis, sd_item, map_name, settings, timings,
+                                                              title or map_name), self._loop)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    # Run a blocking call on the loop's executor, retrying dropped connections with backoff
+    async def _call(self, span, fn, *args):
+        for attempt in range(self.retry.attempts):
+            try:
+                return await self._loop.run_in_executor(None, functools.partial(throttled, self.retry.limiter, fn,
+                                                                                *args))
+            except RETRYABLE as e:
+                if attempt + 1 >= self.retry.attempts:
+                    raise
+                logger.warning('Publish request failed (attempt %s), retrying: %s' % (attempt + 1, e))
+                span['retries'] += 1
+                await asyncio.sleep(self.retry.delay(attempt))
+
+    async def _publish(self, gis, sd_item, map_name, settings, timings, title):
+        index = settings['index']
+        rest_url, token = rest_endpoint(gis)
+        session = rest_session(rest_url, settings['user'], limiter=self.retry.limiter)
+        user_url = '{}content/users/{}'.format(rest_url, settings['user'])
+
+        # Status of the last job on a service item: {'status': ..., 'jobId': ..., 'jobType': ...}
+        def service_status(item_id, job_id=None):
+            params = {'jobId': job_id, 'jobType': 'publish'} if job_id else {}
+            return rest_post(session, '{}/items/{}/status'.format(user_url, item_id), token, params)
+
+        # Feature service published from the SD item, through their relationship rather than a search, which can
+        # lag behind a service that was just created.  None before the first publish.
+        def published_from(item_id):
+            related = rest_post(session, '{}content/items/{}/relatedItems'.format(rest_url, item_id), token,
+                                {'relationshipType': 'Service2Data', 'direction': 'reverse'})
+            ids = [i['id'] for i in related.get('relatedItems', []) if i.get('type') == 'Feature Service']
+            return ids[0] if ids else None
+
+        with timed(timings.record, map_name, 'publish', 'Publishing') as span:
+            try:
+                job = None
+                fs = index.get(title, 'Feature Service')
+                if fs is not None:
+                    status = await self._call(span, service_status, fs.id)
+                    if status.get('status') == 'processing' and status.get('jobType', 'publish') == 'publish':
+                        logger.info('A publish job for "%s" is already running, following it.' % map_name)
+                        job = (fs.id, status.get('jobId'))
+
+                attempt = 0
+                while job is None:
+                    submitted = time.time()
+                    try:
+                        response = await self._loop.run_in_executor(None, functools.partial(
+                            rest_post, session, user_url + '/publish', token,
+                            {'itemID': sd_item.id, 'filetype': 'serviceDefinition', 'overwrite': 'true'}))
+                        service = response['services'][0]
+                        if 'error' in service or service.get('success') is False:
+                            raise RuntimeError(service.get('error', service))
+                        job = (service['serviceItemId'], service.get('jobId'))
+                    except RETRYABLE as e:
+                        attempt += 1
+                        span['retries'] += 1
+                        if attempt >= self.retry.attempts:
+                            raise
+                        logger.warning('Publish request for "%s" failed, checking for its job: %s' % (map_name, e))
+                        await asyncio.sleep(self.retry.delay(attempt - 1))
+                        service_id = fs.id if fs is not None else await self._call(span, published_from,
+                                                                                                   sd_item.id)
+                        if service_id is None:
+                            continue
+                        status = await self._call(span, service_status, service_id)
+                        if status.get('status') == 'processing':
+                            job = (service_id, status.get('jobId'))
+                        elif status.get('status') == 'completed':
+                            current = await self._call(span, gis.content.get, service_id)
+                            if getattr(current, 'modified', 0) >= submitted * 1000:
+                                job = (service_id, None)
+
+                # Poll the job until it finishes, backing off between polls
+                service_item_id, job_id = job
+                deadline = time.time() + self.timeout
+                poll = 0
+                while True:
+                    status = await self._call(span, service_status, service_item_id, job_id)
+                    if status.get('status') == 'completed':
+                        break
+                    if status.get('status') == 'failed':
+                        raise RuntimeError(status.get('statusMessage', 'publish job failed'))
+                    if time.time() > deadline:
+                        raise TimeoutError('publish job still %s after %s minutes' % (status.get('status'),
+                                                                                      self.timeout / 60))
+                    await asyncio.sleep(self.poll.delay(poll))
+                    poll += 1
+
+                fs = await self._call(span, gis.content.get, service_item_id)
+                index.put(fs)
+                return fs
+            except Exception as e:
+                span['outcome'] = 'error'
+                logger.error('Could not publish service %s: %s' % (map_name, e))
+                print('**' + str(e) + '**')
+                return None
+
+
+# Convert a local attribute value to the form the hosted service stores, so the two can be compared and sent as edits.
+# Dates become epoch milliseconds, which is how feature services exchange them.
+def service_value(value):
+    if isinstance(value, datetime):
+        return int((value - datetime(1970, 1, 1)).total_seconds() * 1000)
+    return value
+
+
+# Stream the rows of a local layer ordered by its key field: (key, compare value, feature).  The feature is the
+# attributes and geometry in the form edit_features takes, minus the fields the service manages itself.
+def local_rows(source, fields, key_field, compare_field, has_shape):
+    cursor_fields = list(fields) + (['SHAPE@JSON'] if has_shape else [])
+    key_position = fields.index(key_field)
+    compare_position = fields.index(compare_field)
+    with arcpy.da.SearchCursor(source, cursor_fields, sql_clause=(None, 'ORDER BY {}'.format(key_field))) as cursor:
+        for row in cursor:
+            feature = {'attributes': dict((f, service_value(v)) for f, v in zip(fields, row))}
+            if has_shape and row[-1] is not None:
+                feature['geometry'] = json.loads(row[-1])
+            yield row[key_position], service_value(row[compare_position]), feature
+
+
+# Key value as a SQL literal for a where clause
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'%s'" % value.replace("'", "''")
+    return str(value)
+
+
+# Stream the key, compare value and object id of every hosted feature ordered by the key field, one page at a time.
+# Each page starts after the last key of the one before rather than at an offset, so the edits sync_layer sends while
+# the stream is read (all for keys before the page's) do not shift rows out of the pages still to come.  Keys are
+# unique, as key_field identifies a feature.  Pages are read through retry, so each waits on the rate limiter.
+def remote_rows(layer, key_field, compare_field, page_size, retry):
+    oid_field = layer.properties.objectIdField
+    where = '1=1'
+    while True:
+        features = retry.call(lambda: layer.query(where=where, out_fields=','.join([oid_field, key_field,
+                                                                                    compare_field]),
+                                                  order_by_fields='{} ASC'.format(key_field),
+                                                  result_record_count=page_size, return_geometry=False),
+                              'Sync page query').features
+        for feature in features:
+            yield feature.attributes[key_field], feature.attributes[compare_field], feature.attributes[oid_field]
+        if len(features) < page_size:
+            return
+        where = '{} > {}'.format(key_field, sql_literal(features[-1].attributes[key_field]))
+
+
+# Rows of an arcpy cursor generator, each read under _arcpy_lock, so upload threads never use arcpy at once while
+# the network calls between reads run unlocked.
+def locked_rows(rows):
+    try:
+        while True:
+            with _arcpy_lock:
+                row = next(rows, None)
+            if row is None:
+                return
+            yield row
+    finally:
+        with _arcpy_lock:
+            rows.close()
+
+
+# Next row of a key ordered stream, or None at the end.  Raises ValueError when the stream is out of order, which
+# happens when the local and hosted databases collate the key differently.
+def next_row(rows, last_key):
+    row = next(rows, None)
+    if row is not None and last_key is not None and row[0] < last_key:
+        raise ValueError('rows are not ordered by the key field (%s after %s)' % (row[0], last_key))
+    return row
+
+
+# Compare the local field list with the hosted layer's.  Returns the editable local field names, or None when the
+# schemas differ and the service needs a full overwrite.
+def sync_fields(source, layer):
+    local = dict((f.name.lower(), f) for f in arcpy.ListFields(source)
+                 if f.type not in SYSTEM_FIELDS and f.name.lower() not in SYSTEM_FIELD_NAMES)
+    remote = [f['name'].lower() for f in layer.properties.fields
+              if f['type'] not in ('esriFieldTypeOID', 'esriFieldTypeGeometry', 'esriFieldTypeGlobalID')
+              and f['name'].lower() not in SYSTEM_FIELD_NAMES]
+    if sorted(local) != sorted(remote):
+        return None
+    return [local[name].name for name in sorted(local)]
+
+
+# Merge the key ordered local and hosted streams and push the differences to the hosted layer in batches of adds,
+# updates and deletes.  Only one batch of edits is held in memory at a time.  Edits are not retried, as a batch of
+# adds sent twice would add its features twice, but each waits on the rate limiter.  Returns (adds, updates, deletes).
+def sync_layer(source, layer, fields, map_opts, retry):
+    key_field = map_opts['key_field']
+    compare_field = map_opts['compare_field']
+    batch_size = map_opts['batch_size']
+    oid_field = layer.properties.objectIdField
+    page_size = min(batch_size, layer.properties.get('maxRecordCount', batch_size) or batch_size)
+    has_shape = layer.properties.get('geometryType') is not None
+    counts = [0, 0, 0]
+    adds, updates, deletes = [], [], []
+
+    def flush(force=False):
+        if not force and len(adds) + len(updates) + len(deletes) < batch_size:
+            return
+        if adds or updates or deletes:
+            response = throttled(retry.limiter, layer.edit_features, adds=adds, updates=updates,
+                                 deletes=','.join(deletes), rollback_on_failure=True)
+            for result_type in ('addResults', 'updateResults', 'deleteResults'):
+                failed = [r for r in response.get(result_type, []) if not r.get('success')]
+                if failed:
+                    raise RuntimeError('%s %s failed: %s' % (len(failed), result_type, failed[0].get('error')))
+            counts[0] += len(adds)
+            counts[1] += len(updates)
+            counts[2] += len(deletes)
+        del adds[:], updates[:], deletes[:]
+
+    local = locked_rows(local_rows(source, fields, key_field, compare_field, has_shape))
+    remote = remote_rows(layer, key_field, compare_field, page_size, retry)
+    try:
+        local_row = next_row(local, None)
+        remote_row = next_row(remote, None)
+        while local_row is not None or remote_row is not None:
+            if remote_row is None or (local_row is not None and local_row[0] < remote_row[0]):
+                adds.append(local_row[2])
+                local_row = next_row(local, local_row[0])
+            elif local_row is None or remote_row[0] < local_row[0]:
+                deletes.append(str(remote_row[2]))
+                remote_row = next_row(remote, remote_row[0])
+            else:
+                if local_row[1] != remote_row[1]:
+                    local_row[2]['attributes'][oid_field] = remote_row[2]
+                    updates.append(local_row[2])
+                local_row = next_row(local, local_row[0])
+                remote_row = next_row(remote, remote_row[0])
+            flush()
+        flush(force=True)
+    finally:
+        local.close()
+    return tuple(counts)
+
+
+# Push a map's changes to its existing hosted feature service as edits instead of overwriting it.  Each local layer
+# is matched to the hosted layer of the same name and diffed by the map's key_field and compare_field (an edit date
+# or row-hash column).  The owner must be able to edit the service.  Returns 'synced', 'failed', or 'overwrite' when
+# the service is missing or its schema changed and only a full overwrite will do.
+def sync_map(gis, map_name, settings, map_opts, timings):
+    fs = settings['index'].get(map_name, 'Feature Service')
+    if fs is None:
+        logger.info('No feature service for "%s" yet, publishing in full.' % map_name)
+        return 'overwrite'
+
+    totals = [0, 0, 0]
+    with timed(timings.record, map_name, 'sync', 'Sync Edits') as span:
+        try:
+            flc = arcgis.features.FeatureLayerCollection(fs.url, gis)
+            hosted = dict((layer.properties.name, layer) for layer in flc.layers + flc.tables)
+            pro_map = open_project(settings['project']).listMaps(map_name)[0]
+            for local_layer in pro_map.listLayers() + pro_map.listTables():
+                if not local_layer.supports('DATASOURCE'):
+                    continue
+                layer = hosted.get(local_layer.name)
+                with _arcpy_lock:
+                    fields = sync_fields(local_layer.dataSource, layer) if layer is not None else None
+                if fields is None or map_opts['key_field'] not in fields or map_opts['compare_field'] not in fields:
+                    logger.info('Schema of "%s" in "%s" changed, publishing in full.' % (local_layer.name,
+                                                                                         map_name))
+                    span['outcome'] = 'overwrite'
+                    return 'overwrite'
+                counts = sync_layer(local_layer.dataSource, layer, fields, map_opts, settings['retry'])
+                logger.info('Synced "%s": %s adds, %s updates, %s deletes' % ((local_layer.name,) + counts))
+                totals = [t + c for t, c in zip(totals, counts)]
+        except ValueError as e:
+            logger.warning('Could not diff "%s", publishing in full: %s' % (map_name, e))
+            span['outcome'] = 'overwrite'
+            return 'overwrite'
+        except Exception as e:
+            logger.error('Could not sync "%s": %s' % (map_name, e))
+            span['outcome'] = 'error'
+            return 'failed'
+
+    logger.info('-* Layer "%s" has been synced: %s adds, %s updates, %s deletes. *-' % ((map_name,) + tuple(totals)))
+    print('-* Layer "%s" has been synced: %s adds, %s updates, %s deletes. *-' % ((map_name,) + tuple(totals)))
+    return 'synced'
+
+
+# Runs each submitted call immediately in the calling thread.  Stands in for the pools when not pipelined.
+class InlineExecutor(object):
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+# Process pool for staging that can be started over.  When a staging process dies (Pro crashing inside
+# StageService, a killed process) the process pool breaks and fails every call on it, then and after; restart swaps
+# in a new one.  generation counts the restarts, so callers sharing the pool (the projects of --config, the runs of
+# --watch) restart it once for the same crash.
+class StagingPool(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.generation = 0
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        generation = self.generation
+        try:
+            return self._pool.submit(fn, *args, **kwargs)
+        except concurrent.futures.process.BrokenProcessPool:
+            self.restart(generation)
+            return self._pool.submit(fn, *args, **kwargs)
+
+    def restart(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            logger.warning('A staging process died; starting %s new staging processes' % self.workers)
+            print('A staging process died; starting %s new staging processes' % self.workers)
+            self._pool.shutdown(wait=False)
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            self.generation += 1
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+
+# Staging and upload pools for run_maps.  In pipelined mode staging runs in a process pool and uploads in a thread
+# pool; otherwise both run inline.
+def make_pools(options):
+    if options['pipelined']:
+        logger.info('Pipelined run: %s staging processes, %s upload threads' % (options['stage_workers'],
+                                                                                options['upload_workers']))
+        return (StagingPool(options['stage_workers']),
+                concurrent.futures.ThreadPoolExecutor(max_workers=options['upload_workers']))
+    inline = InlineExecutor()
+    return inline, inline
+
+
+# Stage and publish every map.  In pipelined mode staging runs in a bounded process pool while uploads run in a
+# thread pool, so maps are published as soon as their SD is staged; capabilities, sharing and metadata are
+# reconciled for all published services at the end.  Otherwise each map is
+# staged and published in turn.  Maps whose fingerprint is unchanged since their last publish are skipped unless
+# forced, and maps in sync mode push edits rather than overwrite.  Pools from make_pools can be passed in to keep
+# them warm across runs; otherwise they are made for this run.  Returns the names of the maps that published.
+def run_maps(gis, project_path, map_names, rel_path, settings, options, timings, pools=None):
+    published = []
+    store_path = os.path.join(rel_path, 'AGO_Pro_Update_Fingerprints.json')
+    store = load_fingerprints(store_path) if options['skip_unchanged'] else dict()
+    fingerprints = dict()
+
+    # Remember the fingerprint a map was published with, saving after each map so a crash keeps earlier maps.  The
+    # store is read again before each save, so runs on other machines sharing it (see --shard) keep their maps.
+    def record(map_name):
+        published.append(map_name)
+        if options['skip_unchanged'] and fingerprints.get(map_name) is not None:
+            store[map_name] = fingerprints[map_name]
+            current = load_fingerprints(store_path)
+            current[map_name] = fingerprints[map_name]
+            save_fingerprints(store_path, current)
+
+    # SD sizes of the last untrimmed publish, to report what trimming saves
+    last_sd_bytes = dict()
+    if any(map_options(options, m)['trim'] for m in map_names):
+        last_sd_bytes = timings.last_bytes('stage')
+
+    # Start the longest maps first when running in parallel, so a big map never starts last
+    queue = list(map_names)
+    costs = options.get('costs') or dict()
+    predicted = None
+    if costs and queue:
+        if options['pipelined']:
+            queue.sort(key=lambda m: -costs.get(m, 0))
+        predicted = predict(dict((m, costs.get(m, 0)) for m in queue), lanes(options))
+    started = time.time()
+
+    stage_pool, upload_pool = pools or make_pools(options)
+    monitor = PublishMonitor(options['retry'], options['poll'], options['publish_timeout'])
+
+    def stage(map_name, mode):
+        logger.info('Processing "%s"...' % map_name)
+        print('Processing "%s"...' % map_name)
+        force = options['force'] or mode != map_options(options, map_name)['mode']
+        trim = map_options(options, map_name) if map_options(options, map_name)['trim'] else None
+        service_name = None
+        if mode == 'bluegreen':
+            try:
+                service_name = bluegreen_service(settings['index'], map_name, settings['retry'])
+            except Exception as e:
+                failed = concurrent.futures.Future()
+                failed.set_exception(RuntimeError('Cannot tell which service to publish to: %s' % e))
+                return failed
+            if service_name is None:
+                logger.warning('"%s" is published as a plain service, not a view; rename or remove it to publish '
+                               'blue/green.  Overwriting it instead.' % map_name)
+        generation = getattr(stage_pool, 'generation', 0)
+        future = stage_pool.submit(stage_map, project_path, map_name, rel_path, store.get(map_name), force, mode,
+                                   options['cache'], trim, service_name, options['verify'] is not None,
+                                   options.get('portal'))
+        staging[future] = (mode, generation)
+        return future
+
+    # Each map moves from stage to upload and publish, or from stage to sync (and from sync back to stage when it
+    # needs a full overwrite).  Published services are verified against their data; blue/green maps verify and swap
+    # their live view instead.  Pending futures are tagged with the step they belong to.  Published services are
+    # reconciled together once every map is through; those that did not verify are not recorded as published, so
+    # the next run publishes them again.  When a staging process dies, the staging pool is started over and the
+    # maps it was staging are staged again, as many times as other calls are retried.
+    pending = dict()
+    staging = dict()
+    crashes = collections.Counter()
+    services = list()
+    targets = dict()
+    statistics = dict()
+    published_services = dict()
+    unverified = set()
+    try:
+        while queue or pending:
+            while queue and (options['pipelined'] or not pending):
+                map_name = queue.pop(0)
+                pending[stage(map_name, map_options(options, map_name)['mode'])] = ('stage', map_name)
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                step, map_name = pending.pop(future)
+                mode, generation = staging.pop(future, (None, None))
+                try:
+                    outcome = future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    stage_pool.restart(generation)
+                    crashes[map_name] += 1
+                    if crashes[map_name] >= options['retry'].attempts:
+                        logger.error('Could not stage "%s", the staging process died %s times: %s' %
+                                     (map_name, crashes[map_name], e))
+                        continue
+                    pending[stage(map_name, mode)] = ('stage', map_name)
+                    continue
+                except Exception as e:
+                    logger.error('Could not %s "%s": %s' % (step, map_name, e))
+                    continue
+
+                if step == 'stage':
+                    for span in outcome['spans']:
+                        timings.record(span)
+                    for message in outcome['warnings']:
+                        logger.warning(message)
+                    fingerprints[map_name] = outcome['fingerprint']
+                    statistics[map_name] = outcome['stats']
+                    if outcome['trim'] is not None and outcome['sd'] is not None:
+                        trimmed(map_name, outcome, last_sd_bytes)
+                    if outcome['sync'] and not outcome['unchanged']:
+                        pending[upload_pool.submit(sync_map, gis, map_name, settings, map_options(options, map_name),
+                                                   timings)] = ('sync', map_name)
+                    elif staged(outcome):
+                        targets[map_name] = outcome['service']
+                        pending[upload_pool.submit(upload_map, gis, map_name, outcome['sd'], settings, timings,
+                                                   outcome['sd_hash'], outcome['service'],
+                                                   outcome['reuse'])] = ('upload', map_name)
+                elif step == 'upload' and outcome is not None:
+                    print('Publishing service: %s...' % targets[map_name])
+                    logger.info('Publishing service: %s...' % targets[map_name])
+                    pending[monitor.publish(gis, outcome, map_name, settings, timings,
+                                            targets[map_name])] = ('publish', map_name)
+                elif step == 'publish' and outcome is not None and targets[map_name] != map_name:
+                    pending[upload_pool.submit(swap_view, gis, outcome, map_name, statistics[map_name], settings,
+                                               timings, options['verify'])] = ('swap', map_name)
+                elif step == 'publish' and outcome is not None and options['verify'] is not None:
+                    published_services[map_name] = outcome
+                    pending[upload_pool.submit(verify_service, gis, outcome, map_name, statistics[map_name],
+                                               settings, timings, options['verify'])] = ('verify', map_name)
+                elif step == 'verify':
+                    if not outcome:
+                        unverified.add(map_name)
+                    services.append((map_name, published_services[map_name]))
+                elif step in ('publish', 'swap') and outcome is not None:
+                    services.append((map_name, outcome))
+                elif step == 'sync' and outcome == 'overwrite':
+                    pending[stage(map_name, 'overwrite')] = ('stage', map_name)
+                elif outcome == 'synced':
+                    record(map_name)
+
+        reconciling = dict((upload_pool.submit(reconcile_service, gis, fs, map_name, settings, timings), map_name)
+                           for map_name, fs in services)
+        for future in concurrent.futures.as_completed(reconciling):
+            try:
+                if future.result() and reconciling[future] not in unverified:
+                    record(reconciling[future])
+            except Exception as e:
+                logger.error('Could not reconcile "%s": %s' % (reconciling[future], e))
+    finally:
+        if pools is None:
+            stage_pool.shutdown()
+            upload_pool.shutdown()
+        monitor.close()
+
+    if predicted is not None:
+        logger.info('Took %s, predicted %s' % (timedelta(seconds=int(time.time() - started)),
+                                               timedelta(seconds=int(predicted))))
+    return published
+
+
+# Log what trimming did to a map, and its SD size against the map's last untrimmed SD
+def trimmed(map_name, result, last_sd_bytes):
+    size = os.path.getsize(result['sd'])
+    previous = last_sd_bytes.get(map_name)
+    if previous:
+        change = 'down %.0f%% from %.1f MB untrimmed' % ((1 - size / float(previous)) * 100, previous / 1048576.0)
+    else:
+        change = 'no untrimmed SD to compare with'
+    logger.info('Trimmed "%s": %s layers, %s fields dropped, generalized to %.2f m.  SD is %.1f MB, %s.' %
+                (map_name, result['trim']['layers'], result['trim']['fields_dropped'], result['trim']['tolerance_m'],
+                 size / 1048576.0, change))
+    print('Trimmed "%s": SD is %.1f MB, %s.' % (map_name, size / 1048576.0, change))
+
+
+# Log the outcome of staging one map.  Returns True when the SD is ready to upload.
+def staged(result):
+    if result['unchanged']:
+        logger.info('"%s" is unchanged since its last publish, skipping.' % result['map'])
+        print('"%s" is unchanged since its last publish, skipping.' % result['map'])
+        return False
+    if result['error'] is not None:
+        logger.error('%s: %s' % (result['map'], result['error']))
+        print('%s: %s' % (result['map'], result['error']))
+        return False
+    logger.info('SD File Created for "%s".' % result['map'])
+    print('SD File Created for "%s".' % result['map'])
+    return True
+
+
+# Publish the given maps and finish the run's logs: close the timing log, summarize timings across runs and trim the
+# SD cache.  Returns the names of the maps that published.
+def publish_run(gis, project_path, map_names, rel_path, settings, options, timings, log_path, pools=None):
+    try:
+        published_maps = run_maps(gis, project_path, map_names, rel_path, settings, options, timings, pools)
+    finally:
+        timings.close()
+    logger.info('Published %s of %s maps.' % (len(published_maps), len(map_names)))
+    print('Published %s of %s maps.' % (len(published_maps), len(map_names)))
+
+    # Summarize phase timings across runs for monitoring
+    try:
+        timings.write_summary(log_path + os.sep + 'AGO_Pro_Update_Times.prom')
+    except (IOError, OSError) as e:
+        logger.error('Could not write timing summary: %s' % e)
+
+    # Keep the SD cache within its disk budget
+    if options['cache'] is not None:
+        try:
+            evict_sd_cache(options['cache'])
+        except (IOError, OSError) as e:
+            logger.error('Could not trim the SD cache: %s' % e)
+    return published_maps
+
+
+# Change marker of every map in the project: the last-modified marker of the data behind each layer and table (see
+# source_modified), plus the project file's modified time.  Cheap enough to poll, as it reads no schemas.  The marker
+# of editor tracked data is its last edit date, which a delete does not move, so its row count goes in as well.
+# Enterprise data without editor tracking has no marker, so changes to it are only published on demand.
+def map_markers(project_path):
+    project = open_project(project_path)
+    try:
+        project_modified = os.path.getmtime(project_path)
+    except OSError:
+        project_modified = None
+    markers = dict()
+    for pro_map in project.listMaps():
+        marker = [project_modified]
+        for layer in pro_map.listLayers() + pro_map.listTables():
+            if not layer.supports('DATASOURCE'):
+                continue
+            try:
+                desc = arcpy.Describe(layer.dataSource)
+                marker.append(source_modified(layer.dataSource, desc))
+                if getattr(desc, 'editorTrackingEnabled', False) and desc.editedAtFieldName:
+                    marker.append(int(arcpy.management.GetCount(layer.dataSource)[0]))
+            except (arcpy.ExecuteError, arcpy.ExecuteWarning, IOError, OSError):
+                marker.append(None)
+        markers[str(pro_map.name)] = marker
+    return markers
+
+
+# Local control socket for watch mode, listening on 127.0.0.1 only.  Each connection sends one line and gets one line
+# of JSON back:
+#   status          the watcher's state: pending changes, last run, runs so far
+#   publish <map>   publish a map now, even if unchanged ("publish all" for every map)
+#   stop            finish the current run and exit
+def start_control(port, commands, status):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            words = self.rfile.readline(1024).decode('utf-8', 'replace').strip().split(None, 1)
+            command = words[0].lower() if words else ''
+            if command == 'status':
+                reply = status()
+            elif command == 'publish' and len(words) == 2:
+                commands.put(('publish', words[1].strip()))
+                reply = {'queued': words[1].strip()}
+            elif command == 'stop':
+                commands.put(('stop', None))
+                reply = {'stopping': True}
+            else:
+                reply = {'error': 'commands are status, publish <map>|all and stop'}
+            self.wfile.write((json.dumps(reply, sort_keys=True, default=str) + '\n').encode('utf-8'))
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='Control')
+    thread.daemon = True
+    thread.start()
+    logger.info('Control socket listening on 127.0.0.1:%s' % port)
+    return server
+
+
+# Run as a daemon: keep the portal session, content index, project handle and worker pools alive, poll the project's
+# data for changes and publish only the maps that changed.  A change is published once the map has been quiet for
+# debounce_seconds, or latency_seconds after it was first seen if edits keep coming.  Commands arrive on the control
+# socket; the same status is written to Logs/AGO_Pro_Update_Watch.json after every poll.  make_timings returns a
+# fresh Timings for each run.  Returns the last run's Timings.
+def watch(gis, project_path, rel_path, settings, options, make_timings, log_path):
+    watch_options = options['watch']
+    status_path = log_path + os.sep + 'AGO_Pro_Update_Watch.json'
+    commands = queue.Queue()
+    changed = dict()
+    state = {'started': datetime.now().isoformat(), 'runs': 0, 'last_run': None, 'pending': changed}
+    state_lock = threading.Lock()
+
+    def status():
+        with state_lock:
+            return json.loads(json.dumps(state, default=str))
+
+    server = None
+    if watch_options['control_port']:
+        server = start_control(watch_options['control_port'], commands, status)
+    pools = make_pools(options)
+    markers = map_markers(project_path)
+    indexed = time.time()
+    timings = None
+
+    # With change detection on, start with a run over every map to catch up on changes made while not watching
+    if options['skip_unchanged']:
+        for map_name in markers:
+            changed[map_name] = {'first': 0, 'last': 0}
+    logger.info('Watching %s maps for changes every %ss' % (len(markers), watch_options['poll_seconds']))
+    print('Watching %s maps for changes every %ss' % (len(markers), watch_options['poll_seconds']))
+    try:
+        while True:
+            try:
+                command, argument = commands.get(timeout=watch_options['poll_seconds'])
+            except queue.Empty:
+                command, argument = None, None
+            if command == 'stop':
+                break
+            now = time.time()
+
+            # Note when each map's data changed, first and most recently
+            current = map_markers(project_path)
+            with state_lock:
+                for map_name, marker in current.items():
+                    if markers.get(map_name) != marker:
+                        first = changed.get(map_name, {}).get('first', now)
+                        changed[map_name] = {'first': first, 'last': now}
+            markers = current
+
+            forced = list()
+            if command == 'publish':
+                forced = list(markers) if argument.lower() == 'all' else [m for m in markers if m == argument]
+                if not forced:
+                    logger.warning('Control: no map named "%s"' % argument)
+            with state_lock:
+                due = [m for m, seen in changed.items() if m not in forced and
+                       (now - seen['last'] >= watch_options['debounce_seconds'] or
+                        now - seen['first'] >= watch_options['latency_seconds'])]
+            if not forced and not due:
+                with open(status_path + '.tmp', 'w') as f:
+                    json.dump(status(), f, indent=1, sort_keys=True)
+                os.replace(status_path + '.tmp', status_path)
+                continue
+
+            # Pick up items added or removed by hand since the index was built
+            if now - indexed >= watch_options['index_refresh_seconds']:
+                settings['index'].refresh()
+                indexed = now
+
+            published = list()
+            for map_names, run_options in ((forced, dict(options, force=True)), (due, options)):
+                if not map_names:
+                    continue
+                logger.info('Publishing %s' % ', '.join(map_names))
+                timings = make_timings()
+                try:
+                    published += publish_run(gis, project_path, map_names, rel_path, settings, run_options, timings,
+                                             log_path, pools)
+                except Exception as e:
+                    logger.error('Run failed, the maps stay pending: %s' % e)
+                    continue
+
+                # Changes are done with once their run is over, published or not; a map that failed is picked up
+                # again when its data next changes or on demand
+                finished = time.time()
+                with state_lock:
+                    for map_name in map_names:
+                        seen = changed.pop(map_name, None)
+                        if seen is not None and finished - seen['first'] > watch_options['latency_seconds']:
+                            logger.warning('"%s" took %.0fs from change to publish, over the %.0fs target' %
+                                           (map_name, finished - seen['first'], watch_options['latency_seconds']))
+
+            with state_lock:
+                state['runs'] += 1
+                state['last_run'] = {'finished': datetime.now().isoformat(), 'published': published}
+            with open(status_path + '.tmp', 'w') as f:
+                json.dump(status(), f, indent=1, sort_keys=True)
+            os.replace(status_path + '.tmp', status_path)
+    except KeyboardInterrupt:
+        logger.info('Watch interrupted')
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        for pool in set(pools):
+            pool.shutdown()
+    logger.info('Stopped watching after %s runs' % state['runs'])
+    print('Stopped watching after %s runs' % state['runs'])
+    return timings
+
+
+# Log how long each startup phase took, in order, and start over for the next run in this process.  Phases of one
+# project of a multi-project run are tagged with its config name.
+def log_startup():
+    phases = ['%s%s %.2fs' % (span['phase'], ' (%s)' % span['map'] if span['map'] else '', span['seconds'])
+              for span in _startup]
+    logger.info('Startup took %.2fs: %s' % (sum(span['seconds'] for span in _startup), ', '.join(phases)))
+    del _startup[:]
+
+
+# Short name of the organization in an ArcGIS Online organization url (https://yorkcounty.maps.arcgis.com), or None
+# for any other portal url, such as www.arcgis.com.
+def config_org(portal):
+    host = portal.split('//')[-1].split('/')[0].lower()
+    if host.endswith('.maps.arcgis.com'):
+        return host.split('.')[0]
+    return None
+
+
+# --plan: check a config and print what a run would do from the publishing history alone, without signing in or
+# opening the project.  The maps are those published before by the organization of the config's portal url (by any
+# organization in the history when the url does not name one) and those with a [Map:<name>] section, each with the
+# last time of each of its steps, then the estimated run time.  Maps without history are costed as a run costs them
+# (see map_costs), so --shard splits them the same way, as long as the project has no maps the plan cannot see.
+def print_plan(location, name, history, shard=None):
+    values, options = read_config(location, name)
+    portal, project = values[0], values[3]
+    print('%s.cfg is valid: %s maps configured, %s' % (name[:-3], len(options['maps']), project))
+    org = config_org(portal)
+    orgs = sorted(set(o for o, m in history if org is None or o == org))
+    if not orgs:
+        print('No publishing history for %s yet; the first run publishes every map.' % (org or name[:-3]))
+        if options['maps']:
+            orgs = [org or name[:-3]]
+    for org in orgs:
+        maps = sorted(set(m for o, m in history if o == org) | set(options['maps']))
+        costs = map_costs(history, org, maps)
+        if shard is not None:
+            groups, totals = balance(costs, shard[1])
+            maps = [m for m in maps if m in groups[shard[0] - 1]]
+        print('%s: %s maps%s' % (org, len(maps), ', shard %s of %s' % shard if shard is not None else ''))
+        for map_name in maps:
+            steps = history.get((org, map_name))
+            if not steps:
+                print('    %-40s no history, costed at %s' % (map_name, timedelta(seconds=round(costs[map_name]))))
+                continue
+            print('    %-40s %s' % (map_name, ', '.join('%s %s' % (step, timedelta(seconds=round(steps[step][-1])))
+                                                         for step in sorted(steps))))
+        announce(predict(dict((m, costs[m]) for m in maps), lanes(options)), len(maps))
+    if shard is not None and orgs:
+        print('Maps of the project with no history and no [Map:<name>] section are not known without opening it; '
+              'if there are any, the run splits the maps differently.')
+
+
+# Command line switches.  The scheduled task runs without any.
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Overwrite hosted feature services from the maps in an ArcGIS Pro '
+                                                 'project.')
+    parser.add_argument('--force', action='store_true',
+                        help='Publish every map, even those unchanged since their last publish.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, publishing maps as their data changes (see [Watch] in the config).')
+    parser.add_argument('--config', nargs='+', metavar='PATH',
+                        help='Publish the projects of these config files, or of every .cfg file in these folders, '
+                             'together instead of the config next to the script.')
+    parser.add_argument('--stage-workers', type=int, help='With --config, staging processes shared by all projects.')
+    parser.add_argument('--upload-workers', type=int, help='With --config, upload threads shared by all projects.')
+    parser.add_argument('--shard', type=shard_arg, metavar='K/N',
+                        help='Publish only shard K of N, split by publishing times before today so each machine '
+                             'of N gets about the same work.  The machines must share the Logs folder and start on '
+                             'the same day.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Check the config and print the last publishing times of each map and the estimated '
+                             'run time from the publishing history, without signing in or opening the project.')
+    args = parser.parse_args(argv)
+    if args.plan and args.watch:
+        parser.error('--plan only prints what a run would do; it cannot be combined with --watch')
+    if args.watch and args.config:
+        parser.error('--watch runs one project; it cannot be combined with --config')
+    if args.watch and args.shard:
+        parser.error('--watch follows every map of the project; it cannot be combined with --shard')
+    return args
+
+
+# Parse K/N for --shard
+def shard_arg(text):
+    try:
+        shard, count = [int(v) for v in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected K/N, e.g. 2/3')
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError('K must be between 1 and N')
+    return shard, count
+
+
+# Cost each of a job's maps from the publishing history and, with --shard, keep only the maps of this shard.  Without
+# any history for the project the maps keep their order and no finish is predicted.
+def plan_job(job, history, shard=None):
+    costs = map_costs(history, job['org'], job['maps'])
+    if shard is not None:
+        groups, totals = balance(costs, shard[1])
+        job['maps'] = [m for m in job['maps'] if m in groups[shard[0] - 1]]
+        logger.info('%s: shard %s of %s has %s of %s maps, %.0fs of %.0fs' %
+                    (job['name'], shard[0], shard[1], len(job['maps']), len(costs), totals[shard[0] - 1],
+                     sum(totals)))
+    known = any((job['org'], m) in history for m in costs)
+    job['options']['costs'] = costs if known else dict()
+
+
+# Sign into the portal with ArcPy (for Pro licensing) and with the ArcGIS API.  Exits the script when either fails.
+# Sessions are kept per portal and user, so configs sharing a login sign in once.
+def connect(portal, user, password, scriptName):
+    if (portal, user) in _gis_sessions:
+        return _gis_sessions[(portal, user)]
+
+    # Sign into default portal using ArcPY to ensure proper licensing for Pro
+    try:
+        arcpy_sign_in(portal, user, password)
+    except(arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+        logger.error('Could not sign into Portal: %s' % e)
+        sys.exit(1)
+
+    # Login to an existing organization
+    try:
+        gis = arcgis.gis.GIS(portal, user, password)
+        logger.info('Successfully connected to %s' % gis)
+        print('Successfully connected to %s' % gis)
+    except RuntimeError as e:
+        logger.critical('Please check your url in %s.cfg' % (scriptName[:-3]))
+        logger.critical('Please check your credentials in %s.cfg' % (scriptName[:-3]))
+        logger.critical('---- Script Exited Before Finishing ----')
+        sys.exit('---- Script Exited Before Finishing ----Could not connect to ArcGIS Online')
+    _gis_sessions[(portal, user)] = gis
+    return gis
+
+
+# Everything needed to publish one project: read its config file (name.cfg in location), sign in, open the project
+# and index the user's content.  Signed in sessions and content indexes are shared by every config using the same
+# portal and user.  Temporary files go to rel_path.  Returns the job as a dict.
+def prepare_job(location, name, rel_path, force=False):
+    # Parse through config file
+    with timed(_startup.append, name[:-3], 'config'):
+        (portal, user, password, project, shrOrg, shrEveryone, shrGroups, agol_folder, service_capabilities,
+         open_cat), run_options = read_config(location, name)
+    run_options['force'] = force
+
+    # Set up feature service capabilitiy dictionary
+    option_dict = dict()
+    option_dict['capabilities'] = service_capabilities
+
+    # Sign in before opening the project, so Pro is licensed.  arcpy and arcgis are imported first, so the startup
+    # breakdown shows the imports apart from the sign in.
+    arcpy.load()
+    arcgis.load()
+    with timed(_startup.append, name[:-3], 'sign in'):
+        gis = connect(portal, user, password, name)
+
+    # Set the path to the project
+    prjPath = project
+
+    # Local paths to create temporary content
+    if run_options['cache'] is not None and not run_options['cache']['directory']:
+        run_options['cache']['directory'] = rel_path + '/' + 'SDCache'
+
+    # Set your environment and read in maps from ArcGIS Pro
+    try:
+        with timed(_startup.append, name[:-3], 'open project'):
+            prj = open_project(prjPath)
+            mp = prj.listMaps()
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning) as e:
+        print(e)
+        logger.error('Could not Open Project and list maps. Check your project path. %s' % e)
+        print('Could not Open Project and list maps. Check your project path. %s' % e)
+        logger.critical('---- Script Exited Before Finishing ----')
+        sys.exit('---- Script Exited Before Finishing ----Could not connect to Pro Project')
+
+    # Every call to the organization waits on its rate limit, shared by all projects publishing to it
+    org = org_name(gis)
+    if org not in _rate_limits:
+        _rate_limits[org] = RateLimiter(run_options['requests_per_second'])
+    elif _rate_limits[org].rate != run_options['requests_per_second']:
+        logger.warning('%s.cfg asks for %s requests per second to %s, already limited to %s' %
+                       (name[:-3], run_options['requests_per_second'], org, _rate_limits[org].rate))
+    run_options['retry'].limiter = run_options['poll'].limiter = _rate_limits[org]
+
+    try:
+        # Creates a folder the given folder name from config file. Does nothing if the folder already exists.
+        # If owner is not specified, owner is set as the logged in user.
+        throttled(_rate_limits[org], gis.content.create_folder, folder=agol_folder, owner=user)
+        logger.info('Portal Folder: %s' % agol_folder)
+    except RuntimeError as e:
+        logger.error('Please check your folder name in %s.cfg' % (name[:-3]))
+
+    # Index the user's content once, so each map's items are found without searching
+    key = (portal, user)
+    with timed(_startup.append, name[:-3], 'index'):
+        content_index = _indexes.get(key)
+        if content_index is None:
+            content_index = _indexes[key] = ContentIndex(gis, user, _rate_limits[org])
+        elif agol_folder and agol_folder.strip() and agol_folder not in content_index.folders:
+            content_index.refresh()
+
+    # IF folder is not set in config, default to root directory
+    if agol_folder == '':
+        agol_folder = '/'
+    elif agol_folder == ' ':
+        agol_folder = '/'
+    elif agol_folder is None:
+        agol_folder = '/'
+
+    # Staging processes sign in for themselves
+    run_options['portal'] = (portal, user, password)
+
+    # Everything the upload threads need to publish, share and describe a service
+    publish_settings = {'user': user,
+                        'project': prjPath,
+                        'upload': run_options['upload'],
+                        'retry': run_options['retry'],
+                        'poll': run_options['poll'],
+                        'index': content_index,
+                        'agol_folder': agol_folder,
+                        'option_dict': option_dict,
+                        'shrOrg': shrOrg,
+                        'shrEveryone': shrEveryone,
+                        'shrGroups': shrGroups,
+                        'open_cat': open_cat}
+
+    return {'name': name[:-3],
+            'gis': gis,
+            'org': org,
+            'project': prjPath,
+            'maps': [str(pro_map.name) for pro_map in mp],
+            'rel_path': rel_path,
+            'settings': publish_settings,
+            'options': run_options}
+
+
+# Config files named on the command line: files as given, and every .cfg file in a directory, in name order.
+def config_paths(paths):
+    configs = list()
+    for path in paths:
+        if os.path.isdir(path):
+            configs += sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.cfg'))
+        else:
+            configs.append(path)
+    return [os.path.abspath(c) for c in configs]
+
+
+# Publish the projects of several config files together.  Each project runs its own run_maps, but all of them share
+# one staging pool and one upload pool, which set the global limits on concurrent work, and every organization has
+# one rate limit across its projects.  Temporary files are kept apart in tempDir/<config name>; timings of every
+# project go to the one timing log, tagged with their project, and a summary per project is written to
+# AGO_Pro_Update_Fleet.json in the log folder.  Returns the Timings of the whole run.
+def run_fleet(configs, script_dir, log_path, args, make_timings, history):
+    jobs = list()
+    for config in configs:
+        rel_path = os.path.join(script_dir, 'tempDir', os.path.splitext(os.path.basename(config))[0])
+        if not os.path.isdir(rel_path):
+            os.makedirs(rel_path)
+        logger.info('Preparing %s' % config)
+        try:
+            job = prepare_job(os.path.dirname(config), os.path.splitext(os.path.basename(config))[0] + '.py',
+                              rel_path, args.force)
+            plan_job(job, history, args.shard)
+            jobs.append(job)
+        except (Exception, SystemExit) as e:
+            logger.error('Skipping %s, it could not be prepared: %s' % (config, e))
+            print('Skipping %s, it could not be prepared: %s' % (config, e))
+
+    # Global limits: the command line, or the largest any config asks for
+    fleet_options = {'pipelined': True,
+                     'stage_workers': args.stage_workers or max([j['options']['stage_workers'] for j in jobs] or [1]),
+                     'upload_workers': args.upload_workers or max([j['options']['upload_workers'] for j in jobs] or
+                                                                  [1])}
+    log_startup()
+    pools = make_pools(fleet_options)
+    timings = make_timings()
+
+    # Start the projects with the most work first, and predict the finish of the whole run
+    jobs.sort(key=lambda j: -sum(j['options']['costs'].get(m, 0) for m in j['maps']))
+    fleet_costs = dict(((j['name'], m), j['options']['costs'].get(m, 0)) for j in jobs for m in j['maps'])
+    if any(fleet_costs.values()):
+        announce(predict(fleet_costs, fleet_options['upload_workers']), len(fleet_costs),
+                 'maps of %s projects' % len(jobs))
+    report = dict()
+
+    def run_job(job):
+        started = time.time()
+        published = run_maps(job['gis'], job['project'], job['maps'], job['rel_path'], job['settings'],
+                             job['options'], timings.scoped(job['org'], job['name']), pools)
+        report[job['name']] = {'org': job['org'], 'project': job['project'], 'maps': len(job['maps']),
+                               'published': len(published), 'seconds': round(time.time() - started, 1)}
+
+    started = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as runner:
+            for job, future in [(job, runner.submit(run_job, job)) for job in jobs]:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('Project %s failed: %s' % (job['name'], e))
+                    report[job['name']] = {'org': job['org'], 'project': job['project'], 'maps': len(job['maps']),
+                                           'published': 0, 'error': str(e)}
+    finally:
+        for pool in set(pools):
+            pool.shutdown()
+        timings.close()
+
+    for job in jobs:
+        if job['options']['cache'] is not None:
+            try:
+                evict_sd_cache(job['options']['cache'])
+            except (IOError, OSError) as e:
+                logger.error('Could not trim the SD cache of %s: %s' % (job['name'], e))
+    try:
+        timings.write_summary(log_path + os.sep + 'AGO_Pro_Update_Times.prom')
+    except (IOError, OSError) as e:
+        logger.error('Could not write timing summary: %s' % e)
+
+    # One report for the whole run
+    for name in sorted(report):
+        logger.info('%s: published %s of %s maps' % (name, report[name]['published'], report[name]['maps']))
+        print('%s: published %s of %s maps' % (name, report[name]['published'], report[name]['maps']))
+    summary = {'run': timings.run_id, 'seconds': round(time.time() - started, 1), 'projects': report,
+               'skipped': len(configs) - len(jobs)}
+    with open(log_path + os.sep + 'AGO_Pro_Update_Fleet.json', 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    return timings
+
+
+# Publish every map of the project named in the config file next to the script, or with --config, the projects of
+# several config files.  Config, Logs and tempDir are found relative to script_path, so the same run can be driven by
+# another script.  Returns the run's Timings.
+def main(script_path, argv=None):
+    # Auto Determine where the file location the script was placed, establish location, name, output csv
+    script_dir = os.path.abspath(os.path.dirname(script_path))
+    scriptLocation = script_dir + os.sep + 'Config'
+    scriptName = os.path.basename(script_path)
+    log_path = script_dir + os.sep + 'Logs'
+    csv_path = log_path + os.sep + 'AGO_Pro_Update_Times.csv'
+    file_exists = os.path.isfile(csv_path)
+    args = parse_args(argv)
+
+    # Start Logging
+    logging_start(scriptName, log_path)
+    logger.info('**** Script: %s, was started. ****' % scriptName)
+    print('**** Script: %s, was started. ****' % scriptName)
+    start_time = time.strftime('%X %x %Z')
+
+    # Sessions, indexes and rate limits are shared by the projects of one run only
+    _gis_sessions.clear()
+    _indexes.clear()
+    _rate_limits.clear()
+
+    # Past publishing times, to schedule the longest maps first.  With --shard only days before today count: the
+    # machines splitting a project append to the csv while they run, and must all split it from the same history.
+    with timed(_startup.append, '', 'history'):
+        before = datetime.combine(datetime.now().date(), datetime.min.time()) if args.shard else None
+        history = load_history(csv_path, before=before)
+
+    # Check the configs and print the plan, without signing in
+    if args.plan:
+        configs = config_paths(args.config or [os.path.join(scriptLocation, scriptName[:-3] + '.cfg')])
+        for config in configs:
+            print_plan(os.path.dirname(config), os.path.splitext(os.path.basename(config))[0] + '.py', history,
+                       args.shard)
+        log_startup()
+        logger.info('---- Script: %s completed. ----' % scriptName)
+        print('---- Script: %s completed. ----' % scriptName)
+        return None
+
+    # If output csv that logs publishing times exists, open it.  If not, create & write header.
+    output_file = open(csv_path, 'a')
+    if file_exists is False:
+        output_file.write('LogTime, Org, Service, Type, Duration(Min:Sec:Millsec)\n')
+        print('Writing header...')
+
+    # Every phase of every map is timed to a JSON lines log alongside the csv
+    def make_timings(org=''):
+        return Timings(output_file, org, log_path + os.sep + 'AGO_Pro_Update_Times.jsonl')
+
+    if args.config:
+        timings = run_fleet(config_paths(args.config), script_dir, log_path, args, make_timings, history)
+    else:
+        job = prepare_job(scriptLocation, scriptName, script_dir + '/' + 'tempDir', args.force)
+        plan_job(job, history, args.shard)
+        log_startup()
+        if job['options']['costs'] and not args.watch:
+            announce(predict(dict((m, job['options']['costs'][m]) for m in job['maps']), lanes(job['options'])),
+                     len(job['maps']))
+
+        # Stage and publish each map within the Pro Project.  Make sure map name is identical to feature service
+        # rest URL set for the service
+        if args.watch:
+            timings = watch(job['gis'], job['project'], job['rel_path'], job['settings'], job['options'],
+                            lambda: make_timings(job['org']), log_path)
+        else:
+            timings = make_timings(job['org'])
+            publish_run(job['gis'], job['project'], job['maps'], job['rel_path'], job['settings'], job['options'],
+                        timings, log_path)
+
+    # Close output csv for logging time to publish
+    output_file.close()
+
+    logger.info('---- Script: %s completed. ----' % scriptName)
+    print('---- Script: %s completed. ----' % scriptName)
+    return timings
+
+
+# Main script to call functions & execute publishing process
+if __name__ == "__main__":
+    main(sys.argv[0])
@@ -0,0 +1,222 @@
+"""-------------------------------------------------------------------------------
+Name:       AGO_Pro_Update_Bench.py
+Purpose:    Offline benchmark of AGO_Pro_Update_Transp.py.  Runs the real publishing pipeline end to end against
+            the fake arcpy and arcgis modules in Bench/fakes, with configurable latency, failure injection and map
+            count, then reports throughput (maps/minute), per-phase latency and portal round trips.  Needs no
+            ArcGIS Pro license or ArcGIS Online organization, so it runs on any machine with Python 3.
+Usage:      python Bench/AGO_Pro_Update_Bench.py --maps 40 --runs 2
+            python Bench/AGO_Pro_Update_Bench.py --serial --publish-fail-rate 0.1 --upload-reset-rate 0.1
+-------------------------------------------------------------------------------"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.abspath(os.path.dirname(__file__))
+repo_dir = os.path.dirname(bench_dir)
+fakes_dir = os.path.join(bench_dir, 'fakes')
+script_name = 'AGO_Pro_Update_Transp.py'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the publishing pipeline against fake arcpy/arcgis.')
+    parser.add_argument('--maps', type=int, default=20, help='Maps in the fake project.')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='Runs in a row.  The first publishes new services, later runs overwrite them.')
+    parser.add_argument('--projects', type=int, default=1,
+                        help='Projects of --maps maps each.  More than one runs them together with --config.')
+    parser.add_argument('--rate', type=float, default=0, help='Requests per second allowed to the fake org.')
+    parser.add_argument('--serial', action='store_true', help='Run without the staging and upload pools.')
+    parser.add_argument('--stage-workers', type=int, default=4)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='Turn on change detection (later runs then skip every map).')
+    parser.add_argument('--stage-latency', type=float, default=0.2, help='Seconds of CPU per staged map.')
+    parser.add_argument('--upload-latency', type=float, default=0.3, help='Seconds per SD upload.')
+    parser.add_argument('--publish-latency', type=float, default=0.5, help='Seconds per publish.')
+    parser.add_argument('--search-latency', type=float, default=0.05, help='Seconds per search or listing.')
+    parser.add_argument('--admin-latency', type=float, default=0.05, help='Seconds per share or update call.')
+    parser.add_argument('--sd-kb', type=float, default=256, help='Size of each staged SD file.')
+    parser.add_argument('--upload-reset-rate', type=float, default=0.0,
+                        help='Share of uploads (or multipart parts) that fail with a connection reset.')
+    parser.add_argument('--publish-fail-rate', type=float, default=0.0,
+                        help='Share of publish jobs that fail or whose response is lost (half each).')
+    parser.add_argument('--stage-crash-rate', type=float, default=0.0,
+                        help='Share of maps whose staging process dies the first time they are staged.')
+    parser.add_argument('--retry-seconds', type=float, default=0.05, help='First retry and poll interval.')
+    parser.add_argument('--multipart', action='store_true',
+                        help='Upload every SD in parts to a local HTTP stand-in instead of the fake Item.update.')
+    parser.add_argument('--part-kb', type=float, default=64, help='Multipart part size.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Turn off the SD cache (later runs then stage every map again).')
+    parser.add_argument('--trim', action='store_true',
+                        help='Publish every map trimmed (drop hidden fields and generalize).')
+    parser.add_argument('--partial-rate', type=float, default=0.0,
+                        help='Share of services published a row short, which verification should catch.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Push each run\'s changes to the fake data as edits (sync mode) after the first publish.')
+    parser.add_argument('--bluegreen', action='store_true',
+                        help='Publish every map blue/green: into a backing service, then swap the live view.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Show the script output.')
+    parser.add_argument('--keep', action='store_true', help='Keep the working folder for inspection.')
+    return parser.parse_args(argv)
+
+
+# Point the fakes at the requested latency and failures.  Environment variables reach the staging processes too.
+def configure_fakes(args):
+    os.environ.update({'FAKE_MAP_COUNT': str(args.maps),
+                       'FAKE_STAGE_LATENCY': str(args.stage_latency),
+                       'FAKE_UPLOAD_LATENCY': str(args.upload_latency),
+                       'FAKE_SEARCH_LATENCY': str(args.search_latency),
+                       'FAKE_ADMIN_LATENCY': str(args.admin_latency),
+                       'FAKE_SD_KB': str(args.sd_kb),
+                       'FAKE_PARTIAL_RATE': str(args.partial_rate),
+                       'FAKE_STAGE_CRASH_RATE': str(args.stage_crash_rate),
+                       'FAKE_UPLOAD_RESET_RATE': '0' if args.multipart else str(args.upload_reset_rate),
+                       'FAKE_SEED': str(args.seed)})
+    os.environ['PYTHONPATH'] = os.pathsep.join([fakes_dir, repo_dir] + [p for p in [os.environ.get('PYTHONPATH')]
+                                                                        if p])
+    sys.path[:0] = [fakes_dir, repo_dir]
+
+
+# Lay out a throwaway copy of the script folder: Config (from the real config, with the benchmark's settings),
+# Logs and tempDir.  With more than one project, each gets its own config in Projects.  Returns the path main() is
+# given as the script path.
+def make_workdir(args, rest_url):
+    workdir = tempfile.mkdtemp(prefix='ago_bench_')
+    for folder in ('Config', 'Logs', 'tempDir'):
+        os.makedirs(os.path.join(workdir, folder))
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(repo_dir, 'Config', script_name[:-3] + '.cfg'))
+    config.set('Project', 'location', os.path.join(workdir, 'Bench.aprx'))
+    config.set('Performance', 'requests_per_second', str(args.rate))
+    for section in ('Performance', 'Upload', 'Retry', 'Cache'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set('Performance', 'pipelined', str(not args.serial))
+    config.set('Performance', 'stage_workers', str(args.stage_workers))
+    config.set('Performance', 'upload_workers', str(args.upload_workers))
+    config.set('Performance', 'skip_unchanged', str(args.skip_unchanged))
+    config.set('Cache', 'enabled', str(not args.no_cache))
+    config.set('Cache', 'directory', '')
+    config.set('Upload', 'multipart_mb', '0' if args.multipart else '1000000')
+    config.set('Upload', 'part_mb', str(args.part_kb / 1024.0))
+    # Scale the backoff down with the fake latencies
+    config.set('Retry', 'base_seconds', str(args.retry_seconds))
+    config.set('Retry', 'max_seconds', str(args.retry_seconds * 8))
+    config.set('Retry', 'poll_seconds', str(args.retry_seconds))
+    config.set('Retry', 'poll_max_seconds', str(args.retry_seconds * 8))
+    if args.trim or args.bluegreen or args.sync:
+        for project in range(args.projects):
+            prefix = 'Bench' if args.projects == 1 else 'Project%02d' % project
+            for i in range(args.maps):
+                section = 'Map:%s_Map%02d' % (prefix, i)
+                config.add_section(section)
+                config.set(section, 'trim', str(args.trim))
+                config.set(section, 'mode', 'bluegreen' if args.bluegreen else 'sync' if args.sync else 'overwrite')
+                config.set(section, 'key_field', 'NAME')
+                config.set(section, 'compare_field', 'NOTES')
+    with open(os.path.join(workdir, 'Config', script_name[:-3] + '.cfg'), 'w') as f:
+        config.write(f)
+    if args.projects > 1:
+        os.makedirs(os.path.join(workdir, 'Projects'))
+        for project in range(args.projects):
+            config.set('Project', 'location', os.path.join(workdir, 'Project%02d.aprx' % project))
+            with open(os.path.join(workdir, 'Projects', 'Project%02d.cfg' % project), 'w') as f:
+                config.write(f)
+    os.environ['FAKE_REST_URL'] = rest_url
+    return os.path.join(workdir, script_name)
+
+
+# Summarize one run: throughput, latency per phase and round trips per operation.
+def report(ago, timings, wall, round_trips, standin):
+    published = [s for s in timings.spans if s['phase'] in ('publish', 'sync') and s['outcome'] in ('ok', 'recovered')]
+    phases = dict()
+    for span in timings.spans:
+        phases.setdefault(span['phase'], []).append(span)
+    latency = dict()
+    for phase, spans in sorted(phases.items()):
+        seconds = sorted(s['seconds'] for s in spans)
+        latency[phase] = {'count': len(spans),
+                          'p50': round(ago.quantile(seconds, 0.5), 3),
+                          'p95': round(ago.quantile(seconds, 0.95), 3),
+                          'max': round(seconds[-1], 3),
+                          'retries': sum(s['retries'] for s in spans),
+                          'errors': sum(1 for s in spans if s['outcome'] in ('error', 'mismatch'))}
+    trips = dict(round_trips)
+    trips['rest_http'] = standin.requests
+    return {'wall_seconds': round(wall, 3),
+            'maps_published': len(published),
+            'maps_per_minute': round(len(published) / wall * 60, 1) if wall else 0.0,
+            'staged_mb': round(sum(s.get('bytes', 0) for s in timings.spans if s['phase'] == 'stage') / 1048576.0, 2),
+            'round_trips': sum(trips.values()),
+            'round_trips_by_operation': trips,
+            'phases': latency}
+
+
+def print_report(run, result):
+    print('Run %s: %s maps in %.2fs = %.1f maps/minute, %s round trips, %.2f MB staged' %
+          (run, result['maps_published'], result['wall_seconds'], result['maps_per_minute'], result['round_trips'],
+           result['staged_mb']))
+    print('    %-18s %6s %8s %8s %8s %8s %7s' % ('phase', 'count', 'p50', 'p95', 'max', 'retries', 'errors'))
+    for phase, stats in result['phases'].items():
+        print('    %-18s %6s %8.3f %8.3f %8.3f %8s %7s' % (phase, stats['count'], stats['p50'], stats['p95'],
+                                                         stats['max'], stats['retries'], stats['errors']))
+    print('    round trips: %s' % ', '.join('%s=%s' % kv for kv in sorted(result['round_trips_by_operation'].items())))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_fakes(args)
+    import AGO_Pro_Update_Transp as ago
+    from arcgis import gis as fake_gis
+
+    # Multipart uploads and publish jobs are served by the REST stand-in
+    import rest_standin
+    standin = rest_standin.StandIn(reset_rate=args.upload_reset_rate if args.multipart else 0.0, seed=args.seed,
+                                   publish_latency=args.publish_latency, publish_fail_rate=args.publish_fail_rate)
+    rest_url = standin.start()
+
+    script_path = make_workdir(args, rest_url)
+    results = list()
+    try:
+        for run in range(1, args.runs + 1):
+            fake_gis.ROUND_TRIPS.clear()
+            standin.requests = 0
+            # The fake data changes between runs
+            os.environ['FAKE_DATA_VERSION'] = str(run)
+            output = io.StringIO()
+            started = time.perf_counter()
+            argv = ['--force'] if not args.skip_unchanged else []
+            if args.projects > 1:
+                argv += ['--config', os.path.join(os.path.dirname(script_path), 'Projects')]
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+                timings = ago.main(script_path, argv)
+            wall = time.perf_counter() - started
+            result = report(ago, timings, wall, fake_gis.ROUND_TRIPS, standin)
+            results.append(result)
+            if not args.json:
+                print_report(run, result)
+    finally:
+        standin.stop()
+        if args.keep:
+            print('Working folder: %s' % os.path.dirname(script_path))
+        else:
+            shutil.rmtree(os.path.dirname(script_path), ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+"""Stand-in for the parts of the arcgis module used by AGO_Pro_Update_Transp.py.
+
+Latency and failures are set through environment variables (see gis.py) so they reach every process of a run.
+"""
+from . import gis
+from . import features
@@ -0,0 +1,129 @@
+"""Fake FeatureLayerCollection.  Every service has one layer, named after the service, with the fields of the fake
+arcpy data (see arcpy.da).  Its rows start as the data's first version and are changed by edit_features, so sync mode
+can be run against it; count and extent queries answer as if the service held FAKE_ROW_COUNT rows.
+
+Service definition properties and layer rows are kept per url for the life of the process.
+
+Environment variables:
+    FAKE_ROW_COUNT          rows counted in every layer (default 100)
+    FAKE_PARTIAL_RATE       share of services that come back from publishing a row short (default 0)
+"""
+import itertools
+import os
+import random
+import re
+
+from arcpy import da as _da
+
+from . import gis as _gis
+from .gis import _lock, _round_trip
+
+_definitions = dict()
+_rows = dict()
+_oids = itertools.count(1000000)
+
+
+class _PropertyMap(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class _Feature(object):
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+
+class _FeatureSet(object):
+    def __init__(self, features):
+        self.features = features
+
+
+class _Layer(object):
+    def __init__(self, url):
+        self.url = url
+        self.properties = _PropertyMap(
+            name=url.split('/')[-3], objectIdField='OBJECTID', geometryType='esriGeometryPolygon',
+            maxRecordCount=2000, fields=[{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+                                         {'name': 'NAME', 'type': 'esriFieldTypeString'},
+                                         {'name': 'NOTES', 'type': 'esriFieldTypeString'}])
+
+    # Rows of the layer by object id, seeded from the first version of the fake data
+    def _store(self):
+        if self.url not in _rows:
+            _rows[self.url] = dict((row['OBJECTID'], {'OBJECTID': row['OBJECTID'], 'NAME': row['NAME'],
+                                                      'NOTES': row['NOTES']}) for row in _da.rows(0))
+        return _rows[self.url]
+
+    def query(self, where='1=1', out_fields='*', order_by_fields=None, result_offset=0, result_record_count=None,
+              return_count_only=False, return_extent_only=False, out_sr=None, **kwargs):
+        _round_trip('query', 'FAKE_SEARCH_LATENCY', '0.02')
+        if not (return_count_only or return_extent_only):
+            # Key ordered pages: where is 1=1 or "<field> > <literal>"
+            with _lock:
+                rows = sorted(self._store().values(), key=lambda r: r['NAME'])
+            after = re.match(r"^(\w+) > '(.*)'$", where)
+            if after is not None:
+                rows = [r for r in rows if r[after.group(1)] > after.group(2).replace("''", "'")]
+            rows = rows[result_offset:]
+            if result_record_count is not None:
+                rows = rows[:result_record_count]
+            return _FeatureSet([_Feature(dict(r)) for r in rows])
+        count = int(os.environ.get('FAKE_ROW_COUNT', '100'))
+        if random.Random(self.url).random() < float(os.environ.get('FAKE_PARTIAL_RATE', '0')):
+            count -= 1
+        if return_extent_only:
+            # Matches the extent of the fake arcpy layers
+            xmin, ymin, xmax, ymax = _da.EXTENT
+            return {'count': count, 'extent': {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+                                               'spatialReference': {'wkid': out_sr}}}
+        return count
+
+    def edit_features(self, adds=None, updates=None, deletes=None, rollback_on_failure=True):
+        _round_trip('edit_features', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            store = self._store()
+            for feature in adds or []:
+                oid = next(_oids)
+                store[oid] = dict(feature['attributes'], OBJECTID=oid)
+            for feature in updates or []:
+                store[feature['attributes']['OBJECTID']].update(feature['attributes'])
+            for oid in [int(o) for o in (deletes or '').split(',') if o]:
+                del store[oid]
+        return {'addResults': [{'success': True}] * len(adds or []),
+                'updateResults': [{'success': True}] * len(updates or []),
+                'deleteResults': [{'success': True}] * len([o for o in (deletes or '').split(',') if o])}
+
+
+class _Manager(object):
+    def __init__(self, url, gis):
+        self._url = url
+        self._gis = gis
+
+    def update_definition(self, json_dict):
+        _round_trip('update_definition', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            _definitions.setdefault(self._url, {'capabilities': 'Query'}).update(json_dict)
+        return {'success': True}
+
+    def create_view(self, name, **kwargs):
+        _round_trip('create_view', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            sources = [i for i in _gis._items if i.type == 'Feature Service' and i.url == self._url]
+        return _gis._add_view(self._gis, name, sources[0] if sources else None)
+
+
+class FeatureLayerCollection(object):
+    def __init__(self, url, gis=None):
+        self.url = url
+        self.layers = [_Layer(url + '/0')]
+        self.tables = []
+        self.manager = _Manager(url, gis)
+
+    @property
+    def properties(self):
+        _round_trip('service_definition', 'FAKE_SEARCH_LATENCY', '0.02')
+        with _lock:
+            return dict(_definitions.setdefault(self.url, {'capabilities': 'Query'}))
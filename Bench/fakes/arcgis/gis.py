@@ -0,0 +1,227 @@
+"""Fake GIS, ContentManager, User and Item backed by an in-memory store shared by every GIS of the process.
+
+Environment variables:
+    FAKE_SEARCH_LATENCY     seconds per search or item listing page (default 0.02)
+    FAKE_UPLOAD_LATENCY     seconds per SD upload (default 0.05)
+    FAKE_ADMIN_LATENCY      seconds per share, metadata or service definition update (default 0.01)
+    FAKE_UPLOAD_RESET_RATE  share of uploads that raise ConnectionResetError (default 0)
+    FAKE_SEED               random seed for failure injection (default 1)
+    FAKE_REST_URL           REST url of a rest_standin.StandIn serving multipart uploads and publish jobs
+
+Publishing goes through the stand-in, which owns the feature services; new items are registered with it.
+"""
+import collections
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# Every call that would be a round trip to the portal, by operation
+ROUND_TRIPS = collections.Counter()
+
+_items = []
+_folders = []
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_random = random.Random(int(os.environ.get('FAKE_SEED', '1')))
+
+
+def reset():
+    """Forget all items and round trip counts."""
+    with _lock:
+        del _items[:]
+        del _folders[:]
+        ROUND_TRIPS.clear()
+
+
+def _round_trip(operation, latency_name, default):
+    with _lock:
+        ROUND_TRIPS[operation] += 1
+    time.sleep(float(os.environ.get(latency_name, default)))
+
+
+def _rest(path, data=None):
+    url = os.environ['FAKE_REST_URL'] + path
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    return json.loads(urllib.request.urlopen(url, body).read().decode())
+
+
+def _fails(rate_name):
+    rate = float(os.environ.get(rate_name, '0'))
+    with _lock:
+        return rate > 0 and _random.random() < rate
+
+
+class Item(object):
+    def __init__(self, gis, title, type, owner, item_id=None):
+        self._gis = gis
+        self.id = item_id or '%032x' % next(_ids)
+        self.title = title
+        self.type = type
+        self.owner = owner
+        self.description = None
+        self.tags = None
+        self.licenseInfo = None
+        self.typeKeywords = []
+        self.access = 'private'
+        self._groups = set()
+        self._source = None
+        self.url = 'https://services.example.com/arcgis/rest/services/%s/FeatureServer' % title
+
+    def __repr__(self):
+        return '<Item title:"%s" type:%s owner:%s>' % (self.title, self.type, self.owner)
+
+    def update(self, item_properties=None, data=None):
+        if data is not None:
+            _round_trip('update_data', 'FAKE_UPLOAD_LATENCY', '0.05')
+            if _fails('FAKE_UPLOAD_RESET_RATE'):
+                raise ConnectionResetError('Connection reset by peer')
+        else:
+            _round_trip('update_properties', 'FAKE_ADMIN_LATENCY', '0.01')
+        for key, value in (item_properties or {}).items():
+            if key in ('tags', 'typeKeywords') and isinstance(value, str):
+                value = [v for v in value.split(',') if v]
+            setattr(self, key, value)
+        return True
+
+    def share(self, everyone=False, org=False, groups=None):
+        _round_trip('share', 'FAKE_ADMIN_LATENCY', '0.01')
+        if str(everyone).lower() == 'true':
+            self.access = 'public'
+        elif str(org).lower() == 'true':
+            self.access = 'org'
+        if groups:
+            self._groups.update(g.strip() for g in str(groups).split(','))
+        return {'results': []}
+
+    def delete(self):
+        _round_trip('delete', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            if self in _items:
+                _items.remove(self)
+        return True
+
+    def related_items(self, rel_type, direction='forward'):
+        # Only the source service of a view (Service2Service, reverse) is tracked
+        _round_trip('related_items', 'FAKE_SEARCH_LATENCY', '0.02')
+        if rel_type == 'Service2Service' and direction == 'reverse' and self._source is not None:
+            return [self._source]
+        return []
+
+    @property
+    def shared_with(self):
+        _round_trip('shared_with', 'FAKE_SEARCH_LATENCY', '0.02')
+        return {'everyone': self.access == 'public', 'org': self.access in ('org', 'public'),
+                'groups': sorted(self._groups)}
+
+
+class ContentManager(object):
+    def __init__(self, gis):
+        self._gis = gis
+
+    def search(self, query, item_type=None, max_items=10):
+        _round_trip('search', 'FAKE_SEARCH_LATENCY', '0.02')
+        words = query.split(' AND ')[0]
+        if words.startswith('title:'):
+            words = words[len('title:'):].strip('"')
+        with _lock:
+            return [i for i in _items if words in i.title and (item_type is None or i.type == item_type)][:max_items]
+
+    def get(self, itemid):
+        _round_trip('get', 'FAKE_SEARCH_LATENCY', '0.02')
+        with _lock:
+            for item in _items:
+                if item.id == itemid:
+                    return item
+        # Uploaded or published through the REST stand-in
+        info = _rest('content/items/%s?f=json' % itemid)
+        item = Item(self._gis, info['title'], info['type'], self._gis._user, itemid)
+        item.url = info.get('url', item.url)
+        item.typeKeywords = info.get('typeKeywords', [])
+        with _lock:
+            _items.append(item)
+        return item
+
+    def add(self, item_properties, data=None, folder=None):
+        _round_trip('add', 'FAKE_UPLOAD_LATENCY', '0.05')
+        item = Item(self._gis, item_properties['title'], 'Service Definition', self._gis._user)
+        item.typeKeywords = [k for k in item_properties.get('typeKeywords', '').split(',') if k]
+        _rest('_fake/register', {'id': item.id, 'title': item.title, 'type': item.type})
+        with _lock:
+            _items.append(item)
+        return item
+
+    def replace_service(self, replace_item, new_item, replaced_service_name=None, replace_metadata=False):
+        # The live item keeps its id and url; the view it showed is archived under replaced_service_name
+        _round_trip('replace_service', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            _items.remove(new_item)
+        _add_view(self._gis, replaced_service_name, replace_item._source)
+        replace_item._source = new_item._source
+        return True
+
+    def create_folder(self, folder, owner=None):
+        _round_trip('create_folder', 'FAKE_ADMIN_LATENCY', '0.01')
+        with _lock:
+            if folder not in [f['title'] for f in _folders]:
+                _folders.append({'title': folder, 'id': '%032x' % next(_ids)})
+            return [f for f in _folders if f['title'] == folder][0]
+
+
+def _add_view(gis, title, source=None):
+    with _lock:
+        view = Item(gis, title, 'Feature Service', gis._user)
+        view.typeKeywords = ['View Service']
+        view._source = source
+        _items.append(view)
+    return view
+
+
+class User(object):
+    def __init__(self, gis, username):
+        self._gis = gis
+        self.username = username
+        with _lock:
+            self.folders = list(_folders)
+
+    def items(self, folder=None, max_items=100):
+        # Items do not record their folder, so they are all listed with the root folder
+        with _lock:
+            items = [i for i in _items if i.owner == self.username and folder is None][:max_items]
+        # One round trip per page of 100
+        for page in range(max(1, (len(items) + 99) // 100)):
+            _round_trip('list_items', 'FAKE_SEARCH_LATENCY', '0.02')
+        return items
+
+
+class UserManager(object):
+    def __init__(self, gis):
+        self._gis = gis
+
+    def get(self, username):
+        _round_trip('get_user', 'FAKE_SEARCH_LATENCY', '0.02')
+        return User(self._gis, username)
+
+
+class _Namespace(object):
+    pass
+
+
+class GIS(object):
+    def __init__(self, url=None, username=None, password=None):
+        _round_trip('sign_in', 'FAKE_SEARCH_LATENCY', '0.02')
+        self.url = url
+        self._user = username
+        self.content = ContentManager(self)
+        self.users = UserManager(self)
+        self._portal = _Namespace()
+        self._portal.resturl = os.environ.get('FAKE_REST_URL', 'http://127.0.0.1:9/sharing/rest/')
+        self._con = _Namespace()
+        self._con.token = 'fake-token'
+
+    def __repr__(self):
+        return 'GIS @ https://yorkcounty.maps.arcgis.com version:7.1'
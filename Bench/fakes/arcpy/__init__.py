@@ -0,0 +1,109 @@
+"""Stand-in for the parts of arcpy used by AGO_Pro_Update_Transp.py.
+
+Environment variables:
+    FAKE_MAP_COUNT          maps in every project (default 5)
+    FAKE_DATA_DIR           folder holding one fake file geodatabase per map (default: data next to the project)
+    FAKE_STAGE_LATENCY      seconds of CPU-bound work per StageService_server call (default 0.05)
+    FAKE_SD_KB              size of each staged SD file in kilobytes (default 64)
+    FAKE_ROW_COUNT          rows reported by GetCount (default 100)
+    FAKE_TRIM_RATIO         size of an SD staged from trimmed data, as a share of FAKE_SD_KB (default 0.6)
+    FAKE_STAGE_CRASH_RATE   share of maps whose first StageService_server call kills the staging process (default 0)
+"""
+import os
+import time
+import zlib
+
+from . import mp
+from . import da
+from . import management
+from . import edit
+
+
+class ExecuteError(Exception):
+    pass
+
+
+class ExecuteWarning(Exception):
+    pass
+
+
+class _Env(object):
+    overwriteOutput = False
+
+
+env = _Env()
+
+
+# Processes signed in, as a staging process that has not signed in cannot stage
+_signed_in = set()
+
+
+def SignInToPortal(portal, user, password):
+    _signed_in.add(os.getpid())
+    return {'portal': portal, 'user': user}
+
+
+def StageService_server(sddraft, sd):
+    if os.getpid() not in _signed_in:
+        raise ExecuteError('ERROR 001270: Not signed in to a portal.')
+    # A crash is picked by map name and happens once per SD path, leaving a marker so the next attempt goes through
+    rate = float(os.environ.get('FAKE_STAGE_CRASH_RATE', '0'))
+    if rate and zlib.crc32(os.path.basename(sd).encode()) % 1000 < rate * 1000 and not os.path.exists(sd + '.crashed'):
+        open(sd + '.crashed', 'w').close()
+        os._exit(1)
+    # Spin rather than sleep, as staging keeps a core busy
+    finish = time.perf_counter() + float(os.environ.get('FAKE_STAGE_LATENCY', '0.05'))
+    while time.perf_counter() < finish:
+        pass
+    with open(sddraft, 'rb') as f:
+        draft = f.read()
+    size = int(float(os.environ.get('FAKE_SD_KB', '64')) * 1024)
+    if b'Trim_' in draft:
+        size = int(size * float(os.environ.get('FAKE_TRIM_RATIO', '0.6')))
+    with open(sd, 'wb') as f:
+        f.write((draft * (size // max(len(draft), 1) + 1))[:size])
+
+
+def Exists(path):
+    return os.path.exists(path)
+
+
+class _Field(object):
+    def __init__(self, name, type, length, required=False):
+        self.name = name
+        self.type = type
+        self.length = length
+        self.required = required
+
+
+class _Namespace(object):
+    pass
+
+
+class _Describe(object):
+    def __init__(self, source):
+        self.catalogPath = source
+        self.editorTrackingEnabled = False
+        self.editedAtFieldName = ''
+        self.dataType = 'FeatureClass'
+        self.DSID = 9
+        self.shapeType = 'Polygon'
+        self.extent = _Namespace()
+        self.extent.XMin, self.extent.YMin, self.extent.XMax, self.extent.YMax = da.EXTENT
+        self.spatialReference = _Namespace()
+        self.spatialReference.factoryCode = 2272
+
+
+def Describe(source):
+    return _Describe(source)
+
+
+def ListFields(source):
+    fields = [_Field('OBJECTID', 'OID', 4, True), _Field('NAME', 'String', 50), _Field('NOTES', 'String', 255),
+              _Field('Shape', 'Geometry', 0, True)]
+    path = getattr(source, 'dataSource', source)
+    if os.path.isfile(path + '.dropped'):
+        with open(path + '.dropped') as f:
+            dropped = set(line.strip().lower() for line in f)
+        fields = [f for f in fields if f.name.lower() not in dropped]
+    return fields
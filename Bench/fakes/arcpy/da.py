@@ -0,0 +1,46 @@
+"""Fake arcpy.da.  Every layer holds FAKE_ROW_COUNT rows keyed by NAME (K00000, K00001, ...), with NOTES as the
+column that changes.  FAKE_DATA_VERSION stands for edits between runs: each version leaves out a different seventh of
+the rows and changes NOTES on others, so sync mode has adds, updates and deletes to push.
+"""
+import json
+import os
+
+# Extent of every fake layer, which the fake hosted services report too
+EXTENT = (2200000.0, 200000.0, 2300000.0, 300000.0)
+
+
+class _Extent(object):
+    def __init__(self, bounds):
+        self.XMin, self.YMin, self.XMax, self.YMax = bounds
+
+
+class _Geometry(object):
+    """A shape spanning the whole layer, so the features always cover EXTENT."""
+    extent = _Extent(EXTENT)
+
+
+def rows(version=None):
+    """The fake data as dicts of field values, ordered by NAME."""
+    if version is None:
+        version = int(os.environ.get('FAKE_DATA_VERSION', '0'))
+    for i in range(int(os.environ.get('FAKE_ROW_COUNT', '100'))):
+        if (i + version) % 7 == 0:
+            continue
+        yield {'OBJECTID': i + 1, 'NAME': 'K%05d' % i, 'NOTES': 'v%s' % (i * (version + 1) % 3),
+               'SHAPE@JSON': json.dumps({'rings': [[[i, i], [i + 1, i], [i, i + 1], [i, i]]]}),
+               'SHAPE@': _Geometry()}
+
+
+class SearchCursor(object):
+    def __init__(self, source, fields, where_clause=None, sql_clause=None, **kwargs):
+        # Only the fields sync mode and verification read have values
+        self._rows = [tuple(row.get(f) for f in fields) for row in rows()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        return iter(self._rows)
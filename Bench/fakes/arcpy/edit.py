@@ -0,0 +1,2 @@
+def Generalize(features, tolerance):
+    pass
@@ -0,0 +1,31 @@
+import os
+import shutil
+
+
+def GetCount(source):
+    return [os.environ.get('FAKE_ROW_COUNT', '100')]
+
+
+def Delete(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def CreateFileGDB(folder, name):
+    os.makedirs(os.path.join(folder, name))
+
+
+def _copy(source, output):
+    with open(output, 'w') as f:
+        f.write(getattr(source, 'dataSource', source))
+
+
+CopyFeatures = _copy
+CopyRows = _copy
+
+
+def DeleteField(table, fields):
+    # Dropped fields are listed next to the copy, so ListFields leaves them out
+    if isinstance(fields, str):
+        fields = fields.split(';')
+    with open(table + '.dropped', 'a') as f:
+        f.write(''.join('%s\n' % name for name in fields))
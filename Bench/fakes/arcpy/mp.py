@@ -0,0 +1,81 @@
+"""Fake ArcGISProject, Map, Layer and sharing draft.  Every project has FAKE_MAP_COUNT maps of one layer each, named
+after the project file (Bench.aprx has Bench_Map00, Bench_Map01 and so on)."""
+import os
+
+
+class _Draft(object):
+    def __init__(self, pro_map, service_name):
+        self.pro_map = pro_map
+        self.service_name = service_name
+
+    def exportToSDDraft(self, path):
+        sources = ''.join('<Source>%s</Source>' % layer.dataSource for layer in self.pro_map.listLayers())
+        with open(path, 'w') as f:
+            f.write('<SVCManifest><Name>%s</Name>%s</SVCManifest>\n' % (self.service_name, sources))
+
+
+class _FieldDescription(object):
+    def __init__(self, name, visible):
+        self.fieldName = name
+        self.visible = visible
+
+
+class _Definition(object):
+    def __init__(self):
+        self.featureTable = self
+        self.fieldDescriptions = [_FieldDescription('NAME', True), _FieldDescription('NOTES', False)]
+
+
+class Layer(object):
+    def __init__(self, name, source):
+        self.name = name
+        self.dataSource = source
+        self.definitionQuery = ''
+
+    def supports(self, property_name):
+        return property_name == 'DATASOURCE'
+
+    def getDefinition(self, version):
+        return _Definition()
+
+    @property
+    def connectionProperties(self):
+        return {'connection_info': {'database': os.path.dirname(self.dataSource)},
+                'dataset': os.path.basename(self.dataSource), 'workspace_factory': 'File Geodatabase'}
+
+    def updateConnectionProperties(self, current, new):
+        self.dataSource = os.path.join(new['connection_info']['database'], new['dataset'])
+
+
+class Map(object):
+    def __init__(self, name, data_dir):
+        self.name = name
+        gdb = os.path.join(data_dir, name + '.gdb')
+        if not os.path.isdir(gdb):
+            os.makedirs(gdb)
+            with open(os.path.join(gdb, 'a00000009.gdbtable'), 'w') as f:
+                f.write(name)
+        self._layers = [Layer(name, os.path.join(gdb, name))]
+
+    def listLayers(self, wildcard=None):
+        return list(self._layers)
+
+    def listTables(self, wildcard=None):
+        return []
+
+    def getWebLayerSharingDraft(self, server_type, service_type, service_name):
+        return _Draft(self, service_name)
+
+
+class ArcGISProject(object):
+    def __init__(self, path):
+        self.filePath = path
+        count = int(os.environ.get('FAKE_MAP_COUNT', '5'))
+        data_dir = os.environ.get('FAKE_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(path)), 'data'))
+        prefix = os.path.splitext(os.path.basename(path))[0]
+        self._maps = [Map('%s_Map%02d' % (prefix, i), data_dir) for i in range(count)]
+
+    def listMaps(self, wildcard=None):
+        if wildcard is None:
+            return list(self._maps)
+        return [m for m in self._maps if m.name == wildcard]
@@ -0,0 +1,209 @@
+"""Local HTTP stand-in for the portal REST calls AGO_Pro_Update_Transp.py makes directly.
+
+Serves the multipart upload api (addItem, update, addPart, commit, status, delete), publish jobs and item
+descriptions from memory.  It can drop connections on a share of part uploads, and fail publish jobs or drop the
+response to a share of publish requests, so resumable uploads and publish job tracking can be exercised without a
+portal.  Items created outside of it (the fake ContentManager.add) are made known through /_fake/register.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandIn(object):
+    def __init__(self, reset_rate=0.0, seed=1, publish_latency=0.1, publish_fail_rate=0.0):
+        self.reset_rate = reset_rate
+        self.publish_latency = publish_latency
+        self.publish_fail_rate = publish_fail_rate
+        self.random = random.Random(seed)
+        self.items = dict()
+        self.requests = 0
+        self.resets = 0
+        self.bytes_received = 0
+        self.publishes = 0
+        # Its own id range, apart from the items the fake arcgis module creates
+        self._ids = itertools.count(1 << 100)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                standin.handle(self)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%s/sharing/rest/' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, request):
+        with self._lock:
+            self.requests += 1
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length)
+        form = self._form(request, body)
+        path = request.path.split('?')[0]
+
+        if path.endswith('/addPart'):
+            with self._lock:
+                reset = self.random.random() < self.reset_rate
+                if reset:
+                    self.resets += 1
+            if reset:
+                # Drop the connection without a response, as a reset mid-upload would
+                return self._drop(request)
+        if path.endswith('/publish'):
+            with self._lock:
+                fail = self.random.random() < self.publish_fail_rate
+                drop = fail and self.random.random() < 0.5
+            result = self.publish(form, fail and not drop)
+            if drop:
+                # The job was started but the response never arrives
+                with self._lock:
+                    self.resets += 1
+                return self._drop(request)
+            return self._reply(request, result)
+        self._reply(request, self.route(path, form))
+
+    def register(self, item_id, title, type):
+        with self._lock:
+            self.items.setdefault(item_id, {'title': title, 'type': type, 'parts': dict(), 'status': 'completed',
+                                            'data': b''})
+
+    # Start a publish job on the feature service named after the SD, creating the service on first publish
+    def publish(self, form, fail):
+        sd = self.items.get(form.get('itemID'))
+        if sd is None:
+            return {'error': {'code': 400, 'message': 'Item does not exist or is inaccessible.'}}
+        with self._lock:
+            self.publishes += 1
+            service_id = None
+            for item_id, item in self.items.items():
+                if item['title'] == sd['title'] and item['type'] == 'Feature Service':
+                    service_id = item_id
+            if service_id is None:
+                service_id = '%032x' % next(self._ids)
+                self.items[service_id] = {'title': sd['title'], 'type': 'Feature Service', 'parts': dict(),
+                                          'data': b''}
+            job_id = 'j%031x' % next(self._ids)
+            self.items[service_id].update({'status': 'processing', 'jobId': job_id, 'failed': fail,
+                                           'done': time.time() + self.publish_latency})
+        return {'services': [{'type': 'Feature Service', 'serviceItemId': service_id, 'jobId': job_id,
+                              'serviceurl': self.service_url(sd['title'])}]}
+
+    @staticmethod
+    def service_url(title):
+        return 'https://services.example.com/arcgis/rest/services/%s/FeatureServer' % title
+
+    # Status of an item: uploads are completed by commit, publish jobs once their latency has passed
+    def status(self, item_id, item):
+        if item['type'] == 'Feature Service' and item.get('status') == 'processing' and time.time() >= item['done']:
+            item['status'] = 'failed' if item['failed'] else 'completed'
+        result = {'status': item['status'], 'itemId': item_id}
+        if item['type'] == 'Feature Service':
+            result.update({'jobId': item.get('jobId'), 'jobType': 'publish'})
+            if item['status'] == 'failed':
+                result['statusMessage'] = 'Job failed.'
+        return result
+
+    def route(self, path, form):
+        match = re.search(r'/items/([^/]+)/(\w+)$', path)
+        description = re.search(r'/content/items/([^/]+)$', path)
+        if path.endswith('/_fake/register'):
+            self.register(form['id'], form['title'], form['type'])
+            return {'success': True}
+        if description is not None and description.group(1) in self.items:
+            item = self.items[description.group(1)]
+            info = {'id': description.group(1), 'title': item['title'], 'type': item['type'],
+                    'size': len(item['data']), 'typeKeywords': item.get('typeKeywords', [])}
+            if item['type'] == 'Feature Service':
+                info['url'] = self.service_url(item['title'])
+            return info
+        if path.endswith('/addItem'):
+            with self._lock:
+                item_id = '%032x' % next(self._ids)
+                self.items[item_id] = {'title': form.get('title'), 'type': 'Service Definition', 'parts': dict(),
+                                       'status': 'partial', 'data': b''}
+            return {'success': True, 'id': item_id}
+        if match is None or match.group(1) not in self.items:
+            return {'error': {'code': 400, 'message': 'Item does not exist or is inaccessible.'}}
+        item = self.items[match.group(1)]
+        operation = match.group(2)
+        if operation == 'update':
+            with self._lock:
+                item['parts'] = dict()
+                item['status'] = 'partial'
+            return {'success': True, 'id': match.group(1)}
+        if operation == 'addPart':
+            with self._lock:
+                item['parts'][int(form['partNum'])] = form['file']
+                self.bytes_received += len(form['file'])
+            return {'success': True}
+        if operation == 'commit':
+            with self._lock:
+                item['data'] = b''.join(item['parts'][n] for n in sorted(item['parts']))
+                item['status'] = 'completed'
+                if 'typeKeywords' in form:
+                    item['typeKeywords'] = [k for k in form['typeKeywords'].split(',') if k]
+            return {'success': True, 'id': match.group(1)}
+        if operation == 'status':
+            with self._lock:
+                return self.status(match.group(1), item)
+        if operation == 'delete':
+            with self._lock:
+                del self.items[match.group(1)]
+            return {'success': True, 'itemId': match.group(1)}
+        if operation == 'relatedItems':
+            # Service2Data, reverse: the feature service published from a SD
+            with self._lock:
+                return {'relatedItems': [{'id': item_id, 'title': other['title'], 'type': other['type']}
+                                         for item_id, other in self.items.items()
+                                         if other['title'] == item['title'] and other['type'] == 'Feature Service']}
+        return {'error': {'code': 400, 'message': 'Unknown operation %s' % operation}}
+
+    @staticmethod
+    def _form(request, body):
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            import email.parser
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            form = dict()
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                form[name] = payload if part.get_filename() else payload.decode()
+            return form
+        from urllib.parse import parse_qs
+        query = request.path.split('?')[1] if '?' in request.path else ''
+        pairs = parse_qs(body.decode() + '&' + query)
+        return dict((k, v[0]) for k, v in pairs.items())
+
+    @staticmethod
+    def _drop(request):
+        request.close_connection = True
+        request.connection.close()
+
+    @staticmethod
+    def _reply(request, result):
+        data = json.dumps(result).encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)